@@ -0,0 +1,185 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(ROOT, "helpers"))
+import data
+import instrument
+import xo_archive
+from compact_lc import CompactLightCurve, lc_arrays
+
+import synthetic
+
+# how close the optimiser has to get to count as recovering the injected parameters
+TOLERANCES = {"period": 1e-4, "t0": 0.01, "r": 0.1, "b": 0.2, "rho_star": 0.5, "mean": 1e-4}
+
+
+def _timed(func, *args, repeats=1, **kwargs):
+    """Run a function several times and return the output of the last run and the best wall time"""
+    best = np.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        out = func(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return out, best
+
+
+def bench_remove_outliers(planets, cadences, baseline, noise, n_outliers, repeats):
+    """Time :func:`data.remove_outliers` as the number of planets and cadence change"""
+    results = []
+    for cadence in cadences:
+        for n_planets in planets:
+            lc, truth, guesses = synthetic.make_system(n_planets=n_planets, cadence=cadence, baseline=baseline,
+                                                       noise=noise, n_outliers=n_outliers)
+            containers = {"LightCurve": lc, "CompactLightCurve": CompactLightCurve.from_lightcurve(lc)}
+            for container, this_lc in containers.items():
+                new_lc, wall_time = _timed(data.remove_outliers, this_lc, guesses["pl_orbper"], guesses["pl_tranmid"],
+                                           guesses["pl_trandur"], repeats=repeats)
+
+                # check how many of the injected outliers were caught
+                kept_times = set(lc_arrays(new_lc)[0])
+                caught = np.mean([lc.time.value[i] not in kept_times for i in truth["outlier_inds"]])
+                results.append({"benchmark": "remove_outliers", "container": container, "cadence": cadence,
+                                "n_planets": n_planets, "n_cadences": len(lc), "wall_time": wall_time,
+                                "n_removed": len(lc) - len(new_lc), "fraction_outliers_caught": caught})
+                print(results[-1])
+    return results
+
+
+def bench_berger(sizes, repeats):
+    """Time :func:`xo_archive.get_berger_density` as the number of Gaia IDs grows (including the first load)"""
+    gaia_df = pd.read_csv(os.path.join(ROOT, "helpers", "GKTHCatalog_Table2.csv"), usecols=["dr3_source_id"])
+    rng = np.random.default_rng(0)
+
+    _, first_load = _timed(xo_archive.load_berger_catalog, rebuild=True)
+    results = [{"benchmark": "berger_load", "wall_time": first_load}]
+    print(results[-1])
+
+    for size in sizes:
+        # mostly IDs in the catalog with a few that aren't
+        ids = rng.choice(gaia_df["dr3_source_id"].values, size=size).astype(np.int64)
+        ids[rng.random(size) < 0.1] = 1
+        _, wall_time = _timed(xo_archive.get_berger_density, ids, repeats=repeats)
+        results.append({"benchmark": "get_berger_density", "n_ids": size, "wall_time": wall_time})
+        print(results[-1])
+    return results
+
+
+def bench_fit(planets, cadences, baseline, noise, sample, tune, draws, chains, transit_window):
+    """Time :func:`fit.optimise_model` (and optionally :func:`fit.sample_posteriors`) and check that the
+    optimiser recovers the injected parameters"""
+    # the fitting code (pymc3, exoplanet and Theano) is only needed by this benchmark
+    import fit
+
+    results = []
+    for cadence in cadences:
+        for n_planets in planets:
+            lc, truth, guesses = synthetic.make_system(n_planets=n_planets, cadence=cadence, baseline=baseline,
+                                                       noise=noise, n_outliers=0)
+            texp = synthetic.CADENCES[cadence] / 86400
+
+            with instrument.Metrics() as metrics:
+                (map_soln, model), wall_time = _timed(fit.optimise_model, lc, guesses, texp=texp,
+                                                      transit_window=transit_window)
+            errors = synthetic.recovery_errors(map_soln, truth)
+            stages = {record["stage"]: record for record in metrics.stages}
+            result = {"benchmark": "optimise_model", "cadence": cadence, "n_planets": n_planets,
+                      "n_cadences": len(lc), "transit_window": transit_window, "wall_time": wall_time,
+                      "build_time": stages.get("build_model", {}).get("wall_time"),
+                      "compile_time": stages.get("compile", {}).get("wall_time"),
+                      "optimize_time": stages.get("optimize", {}).get("wall_time"),
+                      "n_logp_grad_evals": stages.get("optimize", {}).get("n_logp_grad_evals"),
+                      "errors": errors,
+                      "recovered": all(errors[key] < TOLERANCES[key] for key in TOLERANCES)}
+            results.append(result)
+            print(result)
+
+            if sample:
+                with instrument.Metrics() as metrics:
+                    trace, wall_time = _timed(fit.sample_posteriors, model, map_soln, tune=tune, draws=draws,
+                                              cores=chains, chains=chains)
+                record = metrics.stages[-1]
+                results.append({"benchmark": "sample_posteriors", "cadence": cadence, "n_planets": n_planets,
+                                "n_cadences": len(lc), "tune": tune, "draws": draws, "chains": chains,
+                                "wall_time": wall_time, "n_logp_grad_evals": record.get("n_logp_grad_evals"),
+                                "peak_rss_mb": record["peak_rss_mb"]})
+                print(results[-1])
+    return results
+
+
+def environment_info():
+    """Collect information about the machine and code version for comparing results"""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True,
+                                text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {"commit": commit, "python": platform.python_version(), "numpy": np.__version__,
+            "machine": platform.machine(), "n_cpus": os.cpu_count(), "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the data and fitting code on synthetic light curves')
+    parser.add_argument('-b', '--benchmarks', default="outliers,berger,fit", type=str,
+                        help='Comma-separated benchmarks to run, any of "outliers", "berger" and "fit"')
+    parser.add_argument('-p', '--planets', default="1,3,6", type=str,
+                        help='Comma-separated numbers of planets')
+    parser.add_argument('-c', '--cadences', default="long,short,fast", type=str,
+                        help='Comma-separated cadences, any of "long", "short" and "fast"')
+    parser.add_argument('--fit_cadences', default="long", type=str,
+                        help='Comma-separated cadences for the fit benchmarks')
+    parser.add_argument('--baseline', default=90.0, type=float,
+                        help='Length of the light curves in days')
+    parser.add_argument('--noise', default=2e-4, type=float,
+                        help='White noise level of the light curves')
+    parser.add_argument('--outliers', default=50, type=int,
+                        help='Number of outliers to inject')
+    parser.add_argument('--berger_sizes', default="10,100,1000,10000", type=str,
+                        help='Comma-separated numbers of Gaia IDs to look up')
+    parser.add_argument('--transit_window', default=None, type=float,
+                        help='Only fit data within this many transit durations of each transit')
+    parser.add_argument('--sample', action='store_true',
+                        help='Also benchmark the posterior sampling (slow)')
+    parser.add_argument('--tune', default=300, type=int, help='Tuning steps when sampling')
+    parser.add_argument('--draws', default=300, type=int, help='Draws when sampling')
+    parser.add_argument('--chains', default=2, type=int, help='Chains when sampling')
+    parser.add_argument('-r', '--repeats', default=3, type=int,
+                        help='Number of repeats for the quick benchmarks (the best time is kept)')
+    parser.add_argument('-o', '--output', default="benchmark_results.json", type=str,
+                        help='Path at which to save the results')
+    args = parser.parse_args()
+
+    benchmarks = args.benchmarks.split(",")
+    planets = [int(n) for n in args.planets.split(",")]
+
+    results = []
+    if "outliers" in benchmarks:
+        results += bench_remove_outliers(planets, args.cadences.split(","), args.baseline, args.noise,
+                                         args.outliers, args.repeats)
+    if "berger" in benchmarks:
+        results += bench_berger([int(n) for n in args.berger_sizes.split(",")], args.repeats)
+    if "fit" in benchmarks:
+        results += bench_fit(planets, args.fit_cadences.split(","), args.baseline, args.noise, args.sample,
+                             args.tune, args.draws, args.chains, args.transit_window)
+
+    with open(args.output, "w") as f:
+        json.dump({"environment": environment_info(), "args": vars(args), "results": results}, f, indent=1,
+                  default=float)
+    print(f"Saved results to {args.output}")
+
+    failed = [result for result in results if result.get("recovered") is False]
+    if len(failed) > 0:
+        print(f"WARNING: the optimiser did not recover the injected parameters in {len(failed)} cases")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
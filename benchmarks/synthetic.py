@@ -0,0 +1,138 @@
+import numpy as np
+
+# exposure times (in seconds) of each Kepler cadence
+CADENCES = {"long": 1800, "short": 60, "fast": 20}
+
+# offset between Julian dates and Barycentric Kepler Julian dates
+BKJD_OFFSET = 2454833.0
+
+# gravitational constant in cgs units
+G_CGS = 6.674e-8
+
+
+def transit_duration(period, ror, b, rho_star):
+    """Approximate total transit duration of a planet on a circular orbit
+
+    Parameters
+    ----------
+    period : `float` or `np.ndarray`
+        Orbital period in days
+    ror : `float` or `np.ndarray`
+        Radius ratio of the planet and star
+    b : `float` or `np.ndarray`
+        Impact parameter
+    rho_star : `float`
+        Stellar density in g/cm^3
+
+    Returns
+    -------
+    duration : `float` or `np.ndarray`
+        Transit duration in hours
+    """
+    period_s = np.asarray(period) * 86400
+    a_over_rstar = (G_CGS * rho_star * period_s**2 / (3 * np.pi))**(1 / 3)
+    chord = np.sqrt(np.maximum((1 + ror)**2 - b**2, 0.0))
+    return np.asarray(period) * 24 / np.pi * np.arcsin(np.minimum(chord / a_over_rstar, 1.0))
+
+
+def make_system(n_planets=2, cadence="long", baseline=90.0, noise=2e-4, n_outliers=50, seed=0,
+                guess_scatter=0.1):
+    """Make a synthetic light curve of a multi-planet system with white noise and outliers
+
+    Parameters
+    ----------
+    n_planets : `int`, optional
+        Number of transiting planets, by default 2
+    cadence : `str`, optional
+        Which cadence to use, one of ``CADENCES``, by default "long"
+    baseline : `float`, optional
+        Length of the light curve in days, by default 90.0 (about one Kepler quarter)
+    noise : `float`, optional
+        Standard deviation of the white noise (relative flux), by default 2e-4
+    n_outliers : `int`, optional
+        Number of outliers to inject (between 10 and 30 standard deviations from the truth), by default 50
+    seed : `int`, optional
+        Random seed, by default 0
+    guess_scatter : `float`, optional
+        How far the initial guesses are from the truth, as a fraction of a transit duration for t0 and a
+        fractional error for everything else, by default 0.1
+
+    Returns
+    -------
+    lc : :class:`~lightkurve.Lightcurve`
+        Synthetic light curve (time in BKJD)
+    truth : `dict`
+        True parameters ("period", "t0" in BKJD, "r", "b", "rho_star", "u", "mean") and "outlier_inds"
+    initial_guesses : `dict`
+        Initial guesses in the format returned by :func:`xo_archive.transpose_parameters`
+    """
+    # only imported here so that the other benchmarks don't need them
+    import exoplanet as xo
+    import lightkurve as lk
+    from astropy.time import Time
+
+    rng = np.random.default_rng(seed)
+    texp = CADENCES[cadence] / 86400
+
+    # draw planets with well separated periods
+    period = np.sort(np.exp(rng.uniform(np.log(2), np.log(30), n_planets)))
+    period *= np.cumprod(np.repeat(1.1, n_planets))
+    t0 = 100 + rng.uniform(0, period)
+    r = rng.uniform(0.015, 0.04, n_planets)
+    b = rng.uniform(0, 0.6, n_planets)
+    rho_star = 1.4
+    u = np.array([0.4, 0.25])
+    mean = 1.0
+
+    t = 100 + np.arange(0, baseline, texp)
+    orbit = xo.orbits.KeplerianOrbit(period=period, t0=t0, b=b, rho_star=rho_star)
+    light_curves = xo.LimbDarkLightCurve(u[0], u[1]).get_light_curve(orbit=orbit, r=r, t=t, texp=texp).eval()
+    flux = mean + light_curves.sum(axis=-1) + rng.normal(0, noise, len(t))
+
+    outlier_inds = rng.choice(len(t), size=min(n_outliers, len(t)), replace=False)
+    flux[outlier_inds] += rng.choice([-1, 1], size=len(outlier_inds)) * rng.uniform(10, 30, len(outlier_inds)) * noise
+
+    lc = lk.LightCurve(time=Time(t, format="bkjd"), flux=flux, flux_err=np.repeat(noise, len(t)))
+
+    duration = transit_duration(period, r, b, rho_star)
+    scatter = 1 + guess_scatter * rng.uniform(-1, 1, (4, n_planets))
+    initial_guesses = {
+        "pl_name": [f"Synthetic {chr(ord('b') + i)}" for i in range(n_planets)],
+        "pl_orbper": period * (1 + 1e-3 * guess_scatter * rng.uniform(-1, 1, n_planets)),
+        "pl_tranmid": t0 + BKJD_OFFSET + guess_scatter * duration / 24 * rng.uniform(-1, 1, n_planets),
+        "pl_trandur": duration * scatter[0],
+        "pl_ratror": np.clip(r * scatter[1], 0.002, 0.099),
+        "pl_imppar": np.clip(b * scatter[2], 0.0, 0.9),
+        "st_dens": [rho_star * scatter[3][0]] * n_planets,
+        "berger_dens": [rho_star * scatter[3][0]] * n_planets,
+    }
+
+    truth = {"period": period, "t0": t0, "r": r, "b": b, "rho_star": rho_star, "u": u, "mean": mean,
+             "outlier_inds": outlier_inds}
+    return lc, truth, initial_guesses
+
+
+def recovery_errors(soln, truth):
+    """Compare an optimised solution to the truth
+
+    Parameters
+    ----------
+    soln : `dict`
+        Optimised parameters
+    truth : `dict`
+        True parameters, see :func:`make_system`
+
+    Returns
+    -------
+    errors : `dict`
+        Maximum absolute error (over all planets) of "t0" (days), "b" and "mean" and maximum fractional error of
+        "period", "r" and "rho_star"
+    """
+    return {
+        "period": float(np.max(np.abs(soln["period"] / truth["period"] - 1))),
+        "t0": float(np.max(np.abs(soln["t0"] - truth["t0"]))),
+        "r": float(np.max(np.abs(soln["r"] / truth["r"] - 1))),
+        "b": float(np.max(np.abs(soln["b"] - truth["b"]))),
+        "rho_star": float(np.abs(soln["rho_star"] / truth["rho_star"] - 1)),
+        "mean": float(np.abs(soln["mean"] - truth["mean"])),
+    }
@@ -0,0 +1,233 @@
+import numpy as np
+
+
+class CompactLightCurve():
+    """A light curve that is just contiguous arrays of times, fluxes and flux errors
+
+    This holds the only parts of a :class:`~lightkurve.LightCurve` that the fitting needs, without any of the
+    overhead of astropy Tables, Quantities and Times. Slicing returns views of the same arrays (no copies) and
+    the arrays can be memory-mapped straight from the light curve cache.
+
+    Parameters
+    ----------
+    time : `np.ndarray`
+        Times of each cadence (always stored as float64 to keep the precision of the timestamps)
+    flux : `np.ndarray`
+        Relative flux of each cadence
+    flux_err : `np.ndarray`
+        Uncertainty on the flux of each cadence
+    time_format : `str`, optional
+        Astropy format of the times, by default "bkjd"
+    time_scale : `str`, optional
+        Astropy scale of the times, by default "tdb"
+    meta : `dict`, optional
+        Any metadata, by default None
+    dtype : `type`, optional
+        Data type of the fluxes and errors, e.g. np.float32 to halve their memory, by default None (keep the
+        type of the arrays that are given)
+    """
+    def __init__(self, time, flux, flux_err, time_format="bkjd", time_scale="tdb", meta=None, dtype=None):
+        # these only copy if they need to (e.g. a different type or a non-contiguous array)
+        self.time = np.ascontiguousarray(time, dtype=np.float64)
+        self.flux = np.ascontiguousarray(flux, dtype=dtype)
+        self.flux_err = np.ascontiguousarray(flux_err, dtype=dtype)
+        if not len(self.time) == len(self.flux) == len(self.flux_err):
+            raise ValueError("`time`, `flux` and `flux_err` must all be the same length")
+        self.time_format = time_format
+        self.time_scale = time_scale
+        self.meta = {} if meta is None else meta
+
+    def __len__(self):
+        return len(self.time)
+
+    def __repr__(self):
+        return f"<CompactLightCurve: {len(self)} cadences, {self.flux.dtype} flux>"
+
+    def __getitem__(self, key):
+        """Select cadences with a slice (a view), boolean mask or array of indices (both copies)"""
+        return CompactLightCurve(self.time[key], self.flux[key], self.flux_err[key], time_format=self.time_format,
+                                 time_scale=self.time_scale, meta=self.meta)
+
+    @property
+    def nbytes(self):
+        """Total size of the arrays in bytes"""
+        return self.time.nbytes + self.flux.nbytes + self.flux_err.nbytes
+
+    def astype(self, dtype):
+        """Get a copy of the light curve with the fluxes and errors converted to a different type
+
+        Parameters
+        ----------
+        dtype : `type`
+            New type, e.g. np.float32
+
+        Returns
+        -------
+        lc : :class:`CompactLightCurve`
+            The converted light curve
+        """
+        return CompactLightCurve(self.time, self.flux, self.flux_err, time_format=self.time_format,
+                                 time_scale=self.time_scale, meta=self.meta, dtype=dtype)
+
+    def phase(self, period, t0):
+        """Get the time since the nearest transit of each cadence
+
+        Parameters
+        ----------
+        period : `float`
+            Orbital period in days
+        t0 : `float`
+            Time of a transit midpoint, in the same format as the light curve
+
+        Returns
+        -------
+        phase : `np.ndarray`
+            Time since the nearest transit in days, between -period/2 and period/2
+        """
+        return (self.time - t0 + 0.5 * period) % period - 0.5 * period
+
+    def fold(self, period, t0):
+        """Fold the light curve on a period
+
+        Parameters
+        ----------
+        period : `float`
+            Orbital period in days
+        t0 : `float`
+            Time of a transit midpoint, in the same format as the light curve
+
+        Returns
+        -------
+        folded : :class:`CompactLightCurve`
+            Light curve with the time since the nearest transit as its time, sorted by phase
+        """
+        phase = self.phase(period, t0)
+        order = np.argsort(phase, kind="stable")
+        return CompactLightCurve(phase[order], self.flux[order], self.flux_err[order], time_format=self.time_format,
+                                 time_scale=self.time_scale, meta={**self.meta, "period": period, "t0": t0})
+
+    @classmethod
+    def from_arrays(cls, arrays, meta=None, dtype=None):
+        """Make a light curve from a dictionary of arrays (e.g. a light curve cache entry) without copying them
+
+        Parameters
+        ----------
+        arrays : `dict`
+            Dictionary of "time", "flux" and "flux_err" arrays (these can be memory-mapped)
+        meta : `dict`, optional
+            Metadata with the "time_format", "time_scale" and "lc_meta" (as saved by the cache), by default None
+        dtype : `type`, optional
+            Data type of the fluxes and errors, by default None (keep the type of the arrays)
+
+        Returns
+        -------
+        lc : :class:`CompactLightCurve`
+            The light curve
+        """
+        meta = {} if meta is None else meta
+        return cls(arrays["time"], arrays["flux"], arrays["flux_err"], time_format=meta.get("time_format", "bkjd"),
+                   time_scale=meta.get("time_scale", "tdb"), meta=meta.get("lc_meta", {}), dtype=dtype)
+
+    @classmethod
+    def from_lightcurve(cls, lc, dtype=None):
+        """Make a compact light curve from a :class:`~lightkurve.LightCurve`
+
+        Masked fluxes become NaNs.
+
+        Parameters
+        ----------
+        lc : :class:`~lightkurve.LightCurve`
+            The light curve
+        dtype : `type`, optional
+            Data type of the fluxes and errors, by default None (float64)
+
+        Returns
+        -------
+        lc : :class:`CompactLightCurve`
+            The compact light curve
+        """
+        time, flux, flux_err = lc_arrays(lc)
+        return cls(time, flux, flux_err, time_format=lc.time.format, time_scale=lc.time.scale,
+                   meta={key: val for key, val in lc.meta.items() if isinstance(val, (str, int, float, bool))},
+                   dtype=dtype)
+
+    def to_lightcurve(self):
+        """Convert to a :class:`~lightkurve.LightCurve`
+
+        Returns
+        -------
+        lc : :class:`~lightkurve.LightCurve`
+            The light curve (with dimensionless fluxes)
+        """
+        import lightkurve as lk
+        from astropy.time import Time
+
+        return lk.LightCurve(time=Time(np.array(self.time), format=self.time_format, scale=self.time_scale),
+                             flux=np.array(self.flux), flux_err=np.array(self.flux_err), meta=dict(self.meta))
+
+
+def _plain(column):
+    """Convert a (possibly masked) Quantity column to a float array, with NaNs for masked values"""
+    if hasattr(column, "mask"):
+        values = np.array(column.unmasked.value, dtype=float)
+        values[np.asarray(column.mask)] = np.nan
+        return values
+    return np.asarray(column.value, dtype=float)
+
+
+def register_time_formats():
+    """Make sure astropy knows the Kepler and TESS time formats ("bkjd" and "btjd") without importing
+    lightkurve, which defines the same formats when it is imported (and then just replaces these)"""
+    from astropy.time import TimeFromEpoch, TIME_FORMATS
+    if "bkjd" in TIME_FORMATS and "btjd" in TIME_FORMATS:
+        return
+
+    class TimeBKJD(TimeFromEpoch):
+        """Barycentric Kepler Julian Date (BJD - 2454833)"""
+        name = "bkjd"
+        unit = 1.0
+        epoch_val = 2454833
+        epoch_val2 = None
+        epoch_scale = "tdb"
+        epoch_format = "jd"
+
+    class TimeBTJD(TimeFromEpoch):
+        """Barycentric TESS Julian Date (BJD - 2457000)"""
+        name = "btjd"
+        unit = 1.0
+        epoch_val = 2457000
+        epoch_val2 = None
+        epoch_scale = "tdb"
+        epoch_format = "jd"
+
+
+def lc_arrays(lc):
+    """Get the times, fluxes and flux errors of either a :class:`~lightkurve.LightCurve` or a
+    :class:`CompactLightCurve` as plain arrays
+
+    Parameters
+    ----------
+    lc : :class:`~lightkurve.LightCurve` or :class:`CompactLightCurve`
+        The light curve
+
+    Returns
+    -------
+    time, flux, flux_err : `np.ndarray`
+        The arrays (these are the arrays of the light curve itself for a :class:`CompactLightCurve`)
+    """
+    if isinstance(lc, CompactLightCurve):
+        return lc.time, lc.flux, lc.flux_err
+    return np.asarray(lc.time.value, dtype=float), _plain(lc.flux), _plain(lc.flux_err)
+
+
+def lc_time_system(lc):
+    """Get the astropy time format and scale of either kind of light curve
+
+    Returns
+    -------
+    time_format, time_scale : `str`
+        Format and scale of the times
+    """
+    if isinstance(lc, CompactLightCurve):
+        return lc.time_format, lc.time_scale
+    return lc.time.format, lc.time.scale
@@ -0,0 +1,148 @@
+import fcntl
+import os
+import sys
+import tempfile
+
+import numpy as np
+
+# root of the Theano compile caches of jobs. Inside a SLURM job this defaults to the node-local scratch ($TMPDIR,
+# or /tmp) so the tasks don't all fight over one lock on the shared file system. Outside SLURM Theano's own
+# default (~/.theano) is used unless this is set.
+CACHE_DIR = os.environ.get("THEANO_CACHE_DIR", None)
+
+# name of the file that marks a compile cache as already pre-warmed
+PREWARMED_FILE = ".prewarmed"
+
+
+def theano_flags():
+    """Get the flags that have been set in ``THEANO_FLAGS`` as a dictionary"""
+    return dict(flag.split("=", 1) for flag in os.environ.get("THEANO_FLAGS", "").split(",") if "=" in flag)
+
+
+def compile_dir():
+    """Work out where the Theano compile cache of this job should be
+
+    The tasks of an array job share a cache (when they land on the same node), otherwise each job has its own.
+
+    Returns
+    -------
+    path : `str` or `None`
+        Path of the cache, or None if Theano's default should be used (outside SLURM when ``CACHE_DIR`` is unset)
+    """
+    job_id = os.environ.get("SLURM_ARRAY_JOB_ID", os.environ.get("SLURM_JOB_ID"))
+    if CACHE_DIR is None and job_id is None:
+        return None
+    root = CACHE_DIR if CACHE_DIR is not None else os.environ.get("TMPDIR", tempfile.gettempdir())
+    return os.path.join(root, f"radius-valley-theano-{job_id if job_id is not None else 'local'}")
+
+
+def configure(path=None):
+    """Point Theano's compile cache at a (node-local) directory
+
+    This sets ``base_compiledir`` in ``THEANO_FLAGS``, so it only affects this process if Theano hasn't been
+    imported yet, as well as any processes that it starts. A ``base_compiledir`` or ``compiledir`` that was
+    already set in ``THEANO_FLAGS`` is always kept.
+
+    Parameters
+    ----------
+    path : `str`, optional
+        Directory to use, by default None (see :func:`compile_dir`)
+
+    Returns
+    -------
+    path : `str` or `None`
+        The directory of the compile cache, or None if Theano's default (or one that was already set) is used
+    """
+    flags = theano_flags()
+    if "compiledir" in flags:
+        return None
+    if "base_compiledir" in flags:
+        return flags["base_compiledir"]
+
+    path = compile_dir() if path is None else path
+    if path is None or "theano" in sys.modules:
+        return None
+    os.makedirs(path, exist_ok=True)
+    os.environ["THEANO_FLAGS"] = ",".join([flag for flag in os.environ.get("THEANO_FLAGS", "").split(",")
+                                           if flag != ""] + [f"base_compiledir={path}"])
+    return path
+
+
+def template_model(n_planets=2, n_cadences=1000, per_cadence_texp=False):
+    """Build a small transit model on synthetic data that needs the same compiled code as a real fit
+
+    The compiled code doesn't depend on the number of cadences or the parameter values. It does depend on
+    whether there is one planet or several (since a single planet's parameters broadcast) and whether there is
+    one exposure time per cadence.
+
+    Parameters
+    ----------
+    n_planets : `int`, optional
+        Number of planets, by default 2
+    n_cadences : `int`, optional
+        Number of cadences in the synthetic light curve, by default 1000
+    per_cadence_texp : `bool`, optional
+        Whether to give each cadence its own exposure time, by default False
+
+    Returns
+    -------
+    model : :class:`fit.TransitModel`
+        The (not yet compiled) model
+    """
+    import compact_lc
+    import fit
+
+    time = np.linspace(100, 130, n_cadences)
+    lc = compact_lc.CompactLightCurve(time, np.ones(n_cadences), np.repeat(1e-3, n_cadences))
+    guesses = {"pl_orbper": list(3.0 * 1.7**np.arange(n_planets)),
+               "pl_tranmid": list(2454833.0 + 101.0 + np.arange(n_planets)),
+               "pl_ratror": [0.02] * n_planets, "pl_imppar": [0.3] * n_planets, "pl_trandur": [2.0] * n_planets,
+               "berger_dens": [1.4], "st_dens": [1.4]}
+    texp = np.repeat(0.5 / 24, n_cadences) if per_cadence_texp else 0.5 / 24
+    return fit.TransitModel(lc, guesses, texp=texp)
+
+
+def prewarm(n_planets=[1, 2], per_cadence_texp=False):
+    """Compile the template models (see :func:`template_model`) into this job's compile cache
+
+    This is done once per cache: while one process is compiling any others wait for it, and once it has
+    finished they just return. Every fit after this only needs to load the compiled code.
+
+    Parameters
+    ----------
+    n_planets : `list`, optional
+        Numbers of planets to compile a model for, by default [1, 2] (which covers any number of planets)
+    per_cadence_texp : `bool`, optional
+        Whether the fits will use one exposure time per cadence, by default False
+
+    Returns
+    -------
+    compiled : `bool`
+        Whether the templates were compiled by this call (False if the cache was already pre-warmed)
+    """
+    def compile_templates():
+        for n in n_planets:
+            model = template_model(n_planets=n, per_cadence_texp=per_cadence_texp)
+            model.point_values(model.model.test_point)
+
+    # Theano's own cache (outside a job) can't be marked, so just compile (this is quick if it's already warm)
+    path = configure()
+    if path is None:
+        compile_templates()
+        return True
+
+    os.makedirs(path, exist_ok=True)
+    marker = os.path.join(path, f"{PREWARMED_FILE}-{int(per_cadence_texp)}")
+    if os.path.exists(marker):
+        return False
+    with open(os.path.join(path, "prewarm.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            # someone else may have pre-warmed it while we were waiting
+            if os.path.exists(marker):
+                return False
+            compile_templates()
+            open(marker, "w").close()
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    return True
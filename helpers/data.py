@@ -1,13 +1,232 @@
-import lightkurve as lk
-import astropy.units as u
+import hashlib
+
 import numpy as np
 
-from astropy.time import Time
+import compact_lc
+import instrument
+import lc_cache
+import mast_mirror
+
+from concurrent.futures import ProcessPoolExecutor
+
+# lightkurve and astropy are slow to import so they are only imported by the functions that use them (which
+# means reading cached light curves and fitting never import lightkurve)
+
+# exposure times (in seconds) of the cadences of each mission
+MISSION_EXPTIMES = {"Kepler": [58.85, 1765.46], "K2": [58.85, 1765.46], "TESS": [20, 120, 200, 600, 1800]}
+
+
+def _lc_to_arrays(lc):
+    """Convert a light curve to a dictionary of plain arrays (and metadata) that can be stored in the cache
+
+    Parameters
+    ----------
+    lc : :class:`~lightkurve.Lightcurve` or :class:`~compact_lc.CompactLightCurve`
+        Light curve to convert
+
+    Returns
+    -------
+    arrays : `dict`
+        Dictionary of "time", "flux" and "flux_err" arrays
+    meta : `dict`
+        Time format and scale, flux unit and any simple metadata of the light curve
+    """
+    time, flux, flux_err = compact_lc.lc_arrays(lc)
+    arrays = {"time": time, "flux": flux, "flux_err": flux_err}
+    time_format, time_scale = compact_lc.lc_time_system(lc)
+    meta = {
+        "time_format": time_format,
+        "time_scale": time_scale,
+        "flux_unit": "" if isinstance(lc, compact_lc.CompactLightCurve) else lc.flux.unit.to_string(),
+        "lc_meta": {key: val for key, val in lc.meta.items() if isinstance(val, (str, int, float, bool))},
+    }
+    return arrays, meta
+
+
+def _arrays_to_lc(arrays, meta):
+    """Convert arrays and metadata from the cache back into a light curve
+
+    Parameters
+    ----------
+    arrays : `dict`
+        Dictionary of "time", "flux" and "flux_err" arrays
+    meta : `dict`
+        Metadata, see :func:`_lc_to_arrays`
+
+    Returns
+    -------
+    lc : :class:`~lightkurve.Lightcurve`
+        The light curve
+    """
+    import astropy.units as u
+    import lightkurve as lk
+    from astropy.time import Time
+
+    unit = u.Unit(meta["flux_unit"])
+    return lk.LightCurve(time=Time(arrays["time"], format=meta["time_format"], scale=meta["time_scale"]),
+                         flux=arrays["flux"] * unit, flux_err=arrays["flux_err"] * unit,
+                         meta=meta["lc_meta"])
+
+
+def estimate_exptimes(time, mission=None):
+    """Estimate the exposure time of each cadence of a light curve that may mix several cadences
+
+    Each cadence is assigned the known exposure time of the mission that is closest (logarithmically) to the
+    time to its nearest neighbour, which is robust to gaps and removed outliers.
+
+    Parameters
+    ----------
+    time : `np.ndarray`
+        Times of each cadence in days, in the order they were stitched (each quarter/sector in time order)
+    mission : `str`, optional
+        Which mission the data is from (a key of ``MISSION_EXPTIMES``), by default None (consider every mission)
+
+    Returns
+    -------
+    texp : `np.ndarray`
+        Exposure time of each cadence in days
+    """
+    known = np.unique(np.concatenate(list(MISSION_EXPTIMES.values()))) if mission not in MISSION_EXPTIMES\
+        else np.asarray(MISSION_EXPTIMES[mission])
+    if len(time) < 2:
+        return np.repeat(known.max() / 86400, len(time))
+
+    # time to the nearest neighbour (the stitched quarters may overlap so ignore the direction)
+    gaps = np.abs(np.diff(np.asarray(time, dtype=float))) * 86400
+    nearest = np.minimum(np.concatenate(([np.inf], gaps)), np.concatenate((gaps, [np.inf])))
+    nearest = np.maximum(nearest, 1e-3)
+
+    closest = np.argmin(np.abs(np.log(nearest)[:, np.newaxis] - np.log(known)), axis=1)
+    return known[closest] / 86400
+
+
+def lc_fingerprint(lc):
+    """Work out a fingerprint of the data in a light curve, to check whether a fit to it is still valid
+
+    Parameters
+    ----------
+    lc : :class:`~lightkurve.Lightcurve` or :class:`~compact_lc.CompactLightCurve`
+        The light curve
+
+    Returns
+    -------
+    fingerprint : `str`
+        Hex digest of the times, fluxes and flux errors
+    """
+    sha = hashlib.sha1()
+    for array in compact_lc.lc_arrays(lc):
+        sha.update(np.ascontiguousarray(array, dtype=float).tobytes())
+    return sha.hexdigest()
+
+
+def _parallel_map(func, items, n_workers=1):
+    """Apply a function to each item, optionally using a pool of processes. The order of the output always
+    matches the order of the input so the result is identical to the serial version.
+
+    Parameters
+    ----------
+    func : `function`
+        Function to apply (must be defined at the top level of a module so it can be pickled)
+    items : `list`
+        Items to which the function is applied
+    n_workers : `int`, optional
+        How many processes to use, by default 1 (run serially in this process)
+
+    Returns
+    -------
+    results : `list`
+        Output of the function for each item
+    """
+    if n_workers is None or n_workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    with ProcessPoolExecutor(max_workers=min(n_workers, len(items))) as executor:
+        return list(executor.map(func, items))
+
+
+def _pld_worker(args):
+    """Read a TargetPixelFile and convert it to a light curve with PLD (used by :func:`get_pld_lightcurves`)"""
+    import lightkurve as lk
+
+    path, pld_kwargs = args
+    return lk.read(path).to_lightcurve(method="pld", **pld_kwargs)
+
+
+def _flatten_worker(args):
+    """Flatten a single light curve (used by :func:`get_flattened_lc`)"""
+    lc, flatten_kwargs = args
+    return lc.flatten(**flatten_kwargs)
+
 
+def get_pld_lightcurves(name, mission=None, exptime=None, pld_kwargs=None, use_cache=True, n_workers=1,
+                        max_downloads=None, offline=None):
+    """Returns the light curves of each quarter/sector of a target, made with Pixel Level Decorrelation (PLD)
 
-def get_flattened_lc(name, mission=None, exptime=None):
+    Parameters
+    ----------
+    name : `str`
+        Target name, see :func:`get_flattened_lc`
+    mission : `str`
+        Which mission to download data from, see :func:`get_flattened_lc`
+    exptime : `int` or "long", "short", "fast", optional
+        Exposure time of desired data products, see :func:`get_flattened_lc`
+    pld_kwargs : `dict`, optional
+        Any extra arguments for the PLD (passed to ``tpf.to_lightcurve``), by default None
+    use_cache : `bool`, optional
+        Whether to use the light curve cache, by default True
+    n_workers : `int`, optional
+        How many processes to use for the PLD (each one handles a different quarter/sector), by default 1
+    max_downloads : `int`, optional
+        How many files to download at once, by default None (see :mod:`mast_mirror`)
+    offline : `bool`, optional
+        Whether to only use products already in the local MAST mirror, by default None (see :mod:`mast_mirror`)
+
+    Returns
+    -------
+    lcs : `list`
+        List of :class:`~lightkurve.Lightcurve`, one for each TargetPixelFile
+    """
+    pld_kwargs = {} if pld_kwargs is None else pld_kwargs
+    key = lc_cache.cache_key(stage="pld", name=name.strip().lower(), mission=mission, exptime=exptime,
+                             pld_kwargs=pld_kwargs)
+
+    if use_cache:
+        arrays, meta = lc_cache.load_entry(key)
+        if arrays is not None:
+            # each light curve is stored one after another, split them back up
+            bounds = np.cumsum(np.concatenate(([0], arrays["lengths"])))
+            return [_arrays_to_lc({col: arrays[col][start:end] for col in ["time", "flux", "flux_err"]},
+                                  lc_meta) for start, end, lc_meta in zip(bounds[:-1], bounds[1:], meta["lcs"])]
+
+    # Search MAST data archive for target pixel files (or the local mirror if offline)
+    with instrument.stage("mast_search"):
+        products = mast_mirror.search_products(name, mission=mission, exptime=exptime, offline=offline)
+
+    # download the related TargetPixelFiles into the mirror (several at once)
+    with instrument.stage("mast_download", n_files=len(products)):
+        paths = mast_mirror.download_products(products, max_downloads=max_downloads, offline=offline)
+
+    # convert TPFs to light curves using Pixel Level Decorrelation
+    with instrument.stage("pld", n_files=len(paths), n_workers=n_workers) as record:
+        lcs = _parallel_map(_pld_worker, [(path, pld_kwargs) for path in paths], n_workers=n_workers)
+        record["n_cadences"] = sum(len(lc) for lc in lcs)
+
+    if use_cache:
+        converted = [_lc_to_arrays(lc) for lc in lcs]
+        arrays = {col: np.concatenate([a[col] for a, _ in converted]) for col in ["time", "flux", "flux_err"]}
+        arrays["lengths"] = np.array([len(lc) for lc in lcs], dtype=np.int64)
+        lc_cache.save_entry(key, arrays, meta={"stage": "pld", "name": name, "mission": mission,
+                                               "exptime": exptime, "lcs": [m for _, m in converted]})
+    return lcs
+
+
+def get_flattened_lc(name, mission=None, exptime=None, pld_kwargs=None, flatten_kwargs=None, use_cache=True,
+                     n_workers=1, flatten_per_quarter=False, max_downloads=None, offline=None, compact=False,
+                     dtype=None):
     """Returns stitched and flattened light curve of a target using MAST data archive 
 
+    Both the light curves made with PLD and the stitched and flattened light curve are cached on disk (see
+    :mod:`lc_cache`) so repeated calls with the same settings don't need to redo any of the work.
+
     Parameters
     ----------
     name : `str`
@@ -20,38 +239,87 @@ def get_flattened_lc(name, mission=None, exptime=None):
            exact exposure time in seconds. 
            For example, exptime=1800 calls for 30 minute data products. 
            By default, all cadence modes are returned (this may make it timeout). 
+    pld_kwargs : `dict`, optional
+        Any extra arguments for the PLD (passed to ``tpf.to_lightcurve``), by default None
+    flatten_kwargs : `dict`, optional
+        Any extra arguments for the flattening (passed to ``lc.flatten``), by default None
+    use_cache : `bool`, optional
+        Whether to use the light curve cache, by default True
+    n_workers : `int`, optional
+        How many processes to use for the PLD (and flattening if ``flatten_per_quarter``), by default 1.
+        The result does not depend on this.
+    flatten_per_quarter : `bool`, optional
+        Whether to flatten each quarter/sector separately (in parallel) before stitching rather than
+        flattening the stitched light curve, by default False. NOTE this is not identical to flattening the
+        stitched light curve since the outlier clipping in the flattening is then done per quarter.
+    max_downloads : `int`, optional
+        How many files to download at once, by default None (see :mod:`mast_mirror`)
+    offline : `bool`, optional
+        Whether to only use products already in the local MAST mirror, by default None (see :mod:`mast_mirror`)
+    compact : `bool`, optional
+        Whether to return a :class:`~compact_lc.CompactLightCurve` rather than a lightkurve LightCurve, by
+        default False. If the light curve is cached then its arrays are memory-mapped rather than read.
+    dtype : `type`, optional
+        Data type of the fluxes of a compact light curve (e.g. np.float32), by default None (float64)
 
     Returns
     -------
-    flat_lc : `lightkurve LightCurve object`
+    flat_lc : `lightkurve LightCurve object` or :class:`~compact_lc.CompactLightCurve`
         Stitched and flattened light curve 
     """     
-    # Search MAST data archive for target pixel files
-    search_results = lk.search_targetpixelfile(name, mission=mission, exptime=exptime)
+    pld_kwargs = {} if pld_kwargs is None else pld_kwargs
+    flatten_kwargs = {} if flatten_kwargs is None else flatten_kwargs
+    key = lc_cache.cache_key(stage="flat", name=name.strip().lower(), mission=mission, exptime=exptime,
+                             pld_kwargs=pld_kwargs, flatten_kwargs=flatten_kwargs,
+                             flatten_per_quarter=flatten_per_quarter)
 
-    # download the related TargetPixelFiles
-    tpfs = search_results.download_all()
+    if use_cache:
+        with instrument.stage("lc_cache_load") as record:
+            arrays, meta = lc_cache.load_entry(key)
+            record["hit"] = arrays is not None
+        if arrays is not None:
+            if compact:
+                return compact_lc.CompactLightCurve.from_arrays(arrays, meta, dtype=dtype)
+            return _arrays_to_lc(arrays, meta)
 
-    # convert TPFs to light curves using Pixel Level Decorrelation
-    lcs = [tpf.to_lightcurve(method="pld") for tpf in tpfs]
+    lcs = get_pld_lightcurves(name, mission=mission, exptime=exptime, pld_kwargs=pld_kwargs,
+                              use_cache=use_cache, n_workers=n_workers, max_downloads=max_downloads,
+                              offline=offline)
+
+    import lightkurve as lk
+
+    with instrument.stage("stitch_flatten", n_cadences=sum(len(lc) for lc in lcs)):
+        if flatten_per_quarter:
+            # flatten each quarter separately and then stitch them together
+            flat_lcs = _parallel_map(_flatten_worker, [(lc, flatten_kwargs) for lc in lcs], n_workers=n_workers)
+            flat_lc = lk.LightCurveCollection(lightcurves=flat_lcs).stitch()
+        else:
+            # collect light curves together
+            lcc = lk.LightCurveCollection(lightcurves=lcs)
 
-    # collect light curves together
-    lcc = lk.LightCurveCollection(lightcurves=lcs)
+            # stitch the collection into a single light curve
+            # and flatten it (removes long-term trends using scipy’s Savitzky-Golay filter)
+            flat_lc = lcc.stitch().flatten(**flatten_kwargs)
 
-    # stitch the collection into a single light curve
-    # and flatten it (removes long-term trends using scipy’s Savitzky-Golay filter)
-    flat_lc = lcc.stitch().flatten()
+    if use_cache:
+        arrays, meta = _lc_to_arrays(flat_lc)
+        meta.update({"stage": "flat", "name": name, "mission": mission, "exptime": exptime,
+                     "flatten_per_quarter": flatten_per_quarter})
+        lc_cache.save_entry(key, arrays, meta=meta)
+    if compact:
+        return compact_lc.CompactLightCurve.from_lightcurve(flat_lc, dtype=dtype)
     return flat_lc
 
 
-def remove_outliers(lc, periods, t0s, durations, regular_sigma=5, transit_sigma=5.6, transit_sigma_upper=5):
+def remove_outliers(lc, periods, t0s, durations, regular_sigma=5, transit_sigma=5.6, transit_sigma_upper=5,
+                    chunk_size=None, return_mask=False):
     """Removes outliers from light curve using sigma clipping (removing flux values that are greater or smaller 
     than the median value by a number of standard deviations). Removes the most extreme outliers from the entire light curve, 
     and removes "less extreme" outliers as long as there is no planet transiting. 
 
     Parameters
     ----------
-    lc : :class:`~lightkurve.Lightcurve` 
+    lc : :class:`~lightkurve.Lightcurve` or :class:`~compact_lc.CompactLightCurve`
         Stitched light curve of planetary system to remove outliers from 
     
     periods : `list`
@@ -76,33 +344,165 @@ def remove_outliers(lc, periods, t0s, durations, regular_sigma=5, transit_sigma=
         not), to catch the most obvious outliers. Default is 5 (more strict than transit_sigma because planets do not cause flux
         values to go above median flux). 
 
+    chunk_size : `int`, optional
+        How many cadences to check for transits at once if the light curve is not sorted in time, by default
+        None (all of them). Set this to limit the memory used for very short cadence data.
+
+    return_mask : `bool`, optional
+        Whether to also return the mask of which cadences were kept, by default False
+
     Returns
     -------
-    new_lc : :class:`~lightkurve.Lightcurve`
-        Light curve with extreme outliers removed during entire series and less extreme outliers removed outside of when 
+    new_lc : :class:`~lightkurve.Lightcurve` or :class:`~compact_lc.CompactLightCurve`
+        Light curve (of the same kind as ``lc``) with extreme outliers removed during entire series and less extreme outliers removed outside of when 
         a planet is transiting. 
+    keep : `np.ndarray`
+        Boolean mask of the cadences of ``lc`` that were kept (only if ``return_mask``)
     """ 
-    # get two outlier masks, one more lenient than the other 
-    # returns points that have been removed 
-    _, outlier_mask = lc.remove_outliers(return_mask=True, sigma=regular_sigma)
-    _, extreme_outlier_mask = lc.remove_outliers(return_mask=True, sigma=transit_sigma,
-                                                 sigma_upper=transit_sigma_upper)
-
-    # count the number of planets in transit per timestep
-    total_in_transit = np.zeros(len(lc.time))
-    for p, t0, t_duration in zip(periods, t0s, durations):
-        phase = (lc.time - Time(t0, format="jd")).to(u.day).value % p
-        half_transit = 0.5 * (t_duration * u.hour).to(u.day).value
-        in_transit = (phase < half_transit) | (phase > p - half_transit)
-        total_in_transit += in_transit.astype(int)
+    from astropy.time import Time
+    compact_lc.register_time_formats()
+
+    with instrument.stage("remove_outliers", n_cadences=len(lc)) as record:
+        # get the times and fluxes as plain arrays (treating any masked values as invalid)
+        time, flux_values, _ = compact_lc.lc_arrays(lc)
+        flux_values = np.asarray(flux_values, dtype=float)
+        time_format, time_scale = compact_lc.lc_time_system(lc)
+
+        # get two outlier masks, one more lenient than the other, from a single set of statistics
+        # returns points that have been removed 
+        outlier_mask, extreme_outlier_mask = sigma_clip_masks(flux_values, [(regular_sigma, regular_sigma),
+                                                                            (transit_sigma, transit_sigma_upper)])
+
+        # convert the transit midpoints to the same time format and scale as the light curve (once for all planets)
+        t0s_lc = getattr(Time(t0s, format="jd"), time_scale).to_value(time_format)
+        durations_days = np.asarray(durations, dtype=float) / 24
+
+        # get a mask for whether there are *any* planets in transit
+        any_in_transit = get_in_transit_mask(time, periods, t0s_lc, durations_days, chunk_size=chunk_size)
+
+        # combine them into masks
+        no_extreme_outliers_ever = ~extreme_outlier_mask
+        no_regular_outliers_outside_transit = ~(outlier_mask & (~any_in_transit))
+
+        # return the fully masked lc
+        keep = no_extreme_outliers_ever & no_regular_outliers_outside_transit
+        new_lc = lc[keep]
+        record["n_removed"] = int((~keep).sum())
+    if return_mask:
+        return new_lc, keep
+    return new_lc
 
-    # get a mask for whether there are *any* planets in transit
-    any_in_transit = total_in_transit > 0
 
-    # combine them into masks
-    no_extreme_outliers_ever = ~extreme_outlier_mask
-    no_regular_outliers_outside_transit = ~(outlier_mask & (~any_in_transit))
+def sigma_clip_masks(values, sigmas, maxiters=5):
+    """Get several iterative sigma clipping masks of the same data, sharing the work between them
+
+    Each mask is identical to that from ``astropy.stats.sigma_clip`` (with the median as the centre and the
+    standard deviation as the spread), which is what ``LightCurve.remove_outliers`` uses. The data are sorted
+    once, so that every iteration of the clipping is just a slice of the sorted data, and the statistics of
+    each slice are only calculated once for all of the masks (the first iteration is always shared).
+
+    Parameters
+    ----------
+    values : `np.ndarray`
+        Data to clip
+    sigmas : `list`
+        A list of (sigma_lower, sigma_upper) tuples, one for each mask
+    maxiters : `int`, optional
+        Maximum number of clipping iterations, by default 5
+
+    Returns
+    -------
+    masks : `list`
+        One boolean mask for each pair of sigmas, True where a value is an outlier (or isn't finite)
+    """
+    finite = np.isfinite(values)
+    sorted_values = np.sort(values[finite])
+
+    stats = {}
+    masks = []
+    for sigma_lower, sigma_upper in sigmas:
+        lo, hi = 0, len(sorted_values)
+        min_value, max_value = -np.inf, np.inf
+        for _ in range(maxiters):
+            if hi == lo:
+                break
+            if (lo, hi) not in stats:
+                data = sorted_values[lo:hi]
+                mid = (hi - lo) // 2
+                median = data[mid] if (hi - lo) % 2 == 1 else np.mean(data[mid - 1:mid + 1])
+                stats[(lo, hi)] = (median, data.std())
+            median, std = stats[(lo, hi)]
+
+            min_value = median - std * sigma_lower
+            max_value = median + std * sigma_upper
+
+            # only ever remove more values, never add any back
+            new_lo = lo + np.searchsorted(sorted_values[lo:hi], min_value, side="left")
+            new_hi = lo + np.searchsorted(sorted_values[lo:hi], max_value, side="right")
+            if new_lo == lo and new_hi == hi:
+                break
+            lo, hi = new_lo, new_hi
+
+        masks.append(~finite | (values < min_value) | (values > max_value))
+    return masks
+
+
+def get_in_transit_mask(time, periods, t0s, durations, chunk_size=None):
+    """Work out which times are during a transit of any planet
+
+    If the times are sorted, only the points near each transit are checked (found with a binary search), 
+    otherwise every point is checked against every planet in chunks of ``chunk_size``.
+
+    Parameters
+    ----------
+    time : `np.ndarray`
+        Times (in days) to check
+    periods : `list`
+        A list of orbital periods (in days) of each planet in the system
+    t0s : `list`
+        A list of transit midpoints of each planet in the system, in the same format as ``time``
+    durations : `list`
+        A list of transit durations (in days) of each planet in the system
+    chunk_size : `int`, optional
+        How many times to check at once if they aren't sorted, by default None (all of them)
+
+    Returns
+    -------
+    any_in_transit : `np.ndarray`
+        Boolean mask, True where at least one planet is transiting
+    """
+    time = np.asarray(time, dtype=float)
+    any_in_transit = np.zeros(len(time), dtype=bool)
+    if len(time) == 0:
+        return any_in_transit
+
+    def in_transit(t, p, t0, half_transit):
+        phase = (t - t0) % p
+        return (phase < half_transit) | (phase > p - half_transit)
+
+    is_sorted = np.all(time[1:] >= time[:-1])
+    for p, t0, t_duration in zip(periods, t0s, durations):
+        half_transit = 0.5 * t_duration
+        if is_sorted:
+            # find the indices of points near each transit (with a little padding for rounding)
+            pad = half_transit + 1e-6
+            n_first = np.floor((time[0] - t0 - pad) / p)
+            n_last = np.ceil((time[-1] - t0 + pad) / p)
+            mids = t0 + np.arange(n_first, n_last + 1) * p
+            starts = np.searchsorted(time, mids - pad, side="left")
+            ends = np.searchsorted(time, mids + pad, side="right")
+
+            # expand the windows into a single array of indices
+            lengths = ends - starts
+            if lengths.sum() == 0:
+                continue
+            offsets = np.cumsum(lengths) - lengths
+            inds = np.repeat(starts - offsets, lengths) + np.arange(lengths.sum())
 
-    # return the fully masked lc
-    new_lc = lc[no_extreme_outliers_ever & no_regular_outliers_outside_transit]
-    return new_lc
\ No newline at end of file
+            # use exactly the same condition as for unsorted data for the points that are close
+            any_in_transit[inds] |= in_transit(time[inds], p, t0, half_transit)
+        else:
+            step = len(time) if chunk_size is None else chunk_size
+            for start in range(0, len(time), step):
+                any_in_transit[start:start + step] |= in_transit(time[start:start + step], p, t0, half_transit)
+    return any_in_transit
@@ -0,0 +1,188 @@
+import os
+
+import numpy as np
+
+import compact_lc
+import data
+import results
+
+# how far either side of the transit (in days) to plot
+PLOT_WINDOW = 0.3
+
+
+def plot_path(output_folder, name, planet_name, fmt="png"):
+    """Path of the plot of the optimised fit of a planet"""
+    return os.path.join(output_folder, f"{name.rstrip()}-opt-fit-{planet_name}.{fmt}")
+
+
+def fold(time, period, t0):
+    """Get the time since the nearest transit of each cadence (for many cadences at once)
+
+    Parameters
+    ----------
+    time : `np.ndarray`
+        Times in days
+    period : `float`
+        Orbital period in days
+    t0 : `float`
+        Time of a transit midpoint, in the same format as ``time``
+
+    Returns
+    -------
+    phase : `np.ndarray`
+        Time since the nearest transit in days
+    """
+    return (time - t0 + 0.5 * period) % period - 0.5 * period
+
+
+def bin_folded(phase, flux, bin_width, window=PLOT_WINDOW):
+    """Bin a folded light curve
+
+    Parameters
+    ----------
+    phase : `np.ndarray`
+        Time since the nearest transit in days
+    flux : `np.ndarray`
+        Flux of each cadence
+    bin_width : `float`
+        Width of the bins in days
+    window : `float`, optional
+        Only bin cadences within this many days of the transit, by default ``PLOT_WINDOW``
+
+    Returns
+    -------
+    centres, means, errors : `np.ndarray`
+        Centre, mean flux and standard error of the mean of each non-empty bin
+    """
+    use = (np.abs(phase) < window) & np.isfinite(flux)
+    bins = np.floor((phase[use] + window) / bin_width).astype(int)
+    counts = np.bincount(bins)
+    filled = counts > 0
+    sums = np.bincount(bins, weights=flux[use])[filled]
+    squares = np.bincount(bins, weights=flux[use]**2)[filled]
+    counts = counts[filled]
+
+    means = sums / counts
+    errors = np.sqrt(np.maximum(squares / counts - means**2, 0) / counts)
+    centres = (np.flatnonzero(filled) + 0.5) * bin_width - window
+    return centres, means, errors
+
+
+def plot_system(time, flux, soln, planet_names, output_folder, name, fmt="png", window=PLOT_WINDOW,
+                bin_width=None, dpi=150):
+    """Plot the folded light curve and optimised model of each planet
+
+    The cadences are drawn as a single rasterised layer (so even vector formats stay small), with the binned
+    light curve and the model on top.
+
+    Parameters
+    ----------
+    time, flux : `np.ndarray`
+        The light curve that was fit (after the outliers were removed)
+    soln : `dict`
+        Optimised parameters
+    planet_names : `list`
+        Names of the planets
+    output_folder : `str`
+        Path to folder in which to place the plots
+    name : `str`
+        Name of the system
+    fmt : `str`, optional
+        File format of the plots, by default "png"
+    window : `float`, optional
+        How far either side of the transit (in days) to plot, by default ``PLOT_WINDOW``
+    bin_width : `float`, optional
+        Width of the bins in days, by default None (a hundredth of the plotted range)
+    dpi : `int`, optional
+        Resolution of the (rasterised parts of the) plots, by default 150
+
+    Returns
+    -------
+    paths : `list`
+        Paths of the plots
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    bin_width = 2 * window / 100 if bin_width is None else bin_width
+
+    # only the cadences that were used in the fit have a model light curve
+    if "data_mask" in soln:
+        time, flux = time[soln["data_mask"]], flux[soln["data_mask"]]
+    model = np.asarray(soln["light_curves"][:len(time)])
+
+    paths = []
+    for i, planet_name in enumerate(planet_names):
+        phase = fold(time, soln["period"][i], soln["t0"][i])
+        near = np.abs(phase) < window
+        order = np.argsort(phase[near])
+
+        fig, ax = plt.subplots()
+        ax.scatter(phase[near], flux[near], s=0.1, color="black", label="data", rasterized=True, zorder=-1000)
+
+        centres, means, errors = bin_folded(phase, flux, bin_width, window=window)
+        ax.errorbar(centres, means, yerr=errors, fmt="o", markersize=2, color="tab:blue", label="binned")
+
+        ax.plot(phase[near][order], model[near, i][order] + soln["mean"], color="firebrick",
+                label="optimised model")
+
+        ax.set_xlim(-window, window)
+        ax.set_xlabel("Time since transit [days]")
+        ax.set_ylabel("Relative flux")
+        ax.set_title(planet_name)
+        ax.legend(fontsize=10, loc=4)
+
+        path = plot_path(output_folder, name, planet_name, fmt=fmt)
+        fig.savefig(path, format=fmt, dpi=dpi, bbox_inches="tight")
+        plt.close(fig)
+        paths.append(path)
+    return paths
+
+
+def render_system(output_folder, name, opt_pass=None, fmt="png", loaded_results=None, **plot_kwargs):
+    """Plot the latest optimised fit of a system using only the stored results and the light curve cache
+
+    Parameters
+    ----------
+    output_folder : `str`
+        Path to folder containing the results (the plots are saved here too)
+    name : `str`
+        Name of the system
+    opt_pass : `int`, optional
+        Which optimisation pass to plot, by default None (the last one)
+    fmt : `str`, optional
+        File format of the plots, by default "png"
+    loaded_results : :class:`~pandas.DataFrame`, optional
+        Results that have already been loaded with :func:`results.load_results`, by default None (load them)
+    **plot_kwargs
+        Any other arguments for :func:`plot_system`
+
+    Returns
+    -------
+    paths : `list`
+        Paths of the plots
+
+    Raises
+    ------
+    LookupError
+        If there are no (complete) results for the system, or its light curve is not in the cache
+    """
+    all_results = results.load_results(output_folder) if loaded_results is None else loaded_results
+    rows = all_results[all_results["system_name"] == name.rstrip()]
+    if len(rows) == 0:
+        raise LookupError(f"There are no results for {name.rstrip()} in {output_folder}")
+    opt_pass = rows["opt_pass"].max() if opt_pass is None else opt_pass
+    rows = rows[rows["opt_pass"] == opt_pass].sort_values("planet_index")
+    soln = results.load_solution(output_folder, name, opt_pass, results=all_results)
+
+    # the light curve is read from the cache (never downloaded again) and the outliers are removed as in the fit
+    exptime = rows["exptime"].iloc[0]
+    lc = data.get_flattened_lc(name, mission=rows["mission"].iloc[0],
+                               exptime=None if np.isnan(exptime) else int(exptime), offline=True, compact=True)
+    if "lc_keep" not in soln:
+        raise LookupError(f"The results of {name.rstrip()} don't record which cadences were fit (`lc_keep`)")
+    time, flux, _ = compact_lc.lc_arrays(lc)
+    time, flux = time[soln["lc_keep"]], flux[soln["lc_keep"]]
+
+    return plot_system(time, flux, soln, list(rows["pl_name"]), output_folder, name, fmt=fmt, **plot_kwargs)
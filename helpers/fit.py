@@ -1,115 +1,689 @@
+import os
+import time
+
+import compile_cache
+
+# the compile cache has to be chosen before Theano is imported (by exoplanet and pymc3)
+compile_cache.configure()
+
+import arviz as az
 import exoplanet as xo
 import numpy as np
 from astropy.time import Time
 import pymc3 as pm
 import pymc3_ext as pmx
+import theano.tensor as tt
+from pymc3.util import is_transformed_name, get_untransformed_name
+from scipy.optimize import minimize
+from threadpoolctl import threadpool_limits
 
-def optimise_model(lc, initial_guesses, texp=0.5 / 24, u_init=[0.3, 0.2]):
-    """Optimise a transit model to fit some data
+import compact_lc
+import data
+import instrument
+import resources
+
+compact_lc.register_time_formats()
+
+
+def reduce_to_transit_windows(time, flux, flux_err, periods, t0s, durations, transit_window=3.0, bin_size=1.0):
+    """Reduce a light curve to the cadences near transits, binning the rest to summarise the baseline
+
+    Parameters
+    ----------
+    time, flux, flux_err : `np.ndarray`
+        The light curve data (time in days)
+    periods : `list`
+        Orbital periods (in days) of each planet
+    t0s : `list`
+        Transit midpoints of each planet, in the same format as ``time``
+    durations : `list`
+        Transit durations (in days) of each planet
+    transit_window : `float` or `list`, optional
+        Keep every cadence within this many transit durations of a mid-transit, either the same for every
+        planet or a list with one value per planet, by default 3.0
+    bin_size : `float`, optional
+        Size of the bins (in days) for the cadences outside of the windows, by default 1.0. Set this to None to
+        ignore them entirely.
+
+    Returns
+    -------
+    time, flux, flux_err : `np.ndarray`
+        The reduced light curve, the cadences in the windows first (in their original order) and then the bins
+    in_window : `np.ndarray`
+        Boolean mask of which of the original cadences are in the windows
+    """
+    windows = np.broadcast_to(np.asarray(transit_window, dtype=float), (len(periods),))
+    in_window = data.get_in_transit_mask(time, periods, t0s, 2 * windows * np.asarray(durations, dtype=float))
+
+    if bin_size is None or np.all(in_window):
+        return time[in_window], flux[in_window], flux_err[in_window], in_window
+
+    # bin the rest with an inverse variance weighted mean
+    out_time, out_flux, out_err = time[~in_window], flux[~in_window], flux_err[~in_window]
+    bins = np.floor((out_time - out_time.min()) / bin_size).astype(int)
+    weights = out_err**-2
+    sum_weights = np.bincount(bins, weights=weights)
+    filled = sum_weights > 0
+    bin_time = (np.bincount(bins, weights=out_time * weights)[filled] / sum_weights[filled])
+    bin_flux = (np.bincount(bins, weights=out_flux * weights)[filled] / sum_weights[filled])
+    bin_err = sum_weights[filled]**-0.5
+
+    return (np.concatenate((time[in_window], bin_time)), np.concatenate((flux[in_window], bin_flux)),
+            np.concatenate((flux_err[in_window], bin_err)), in_window)
+
+
+def _initial_density(initial_guesses):
+    """Work out the initial guess of the stellar density from a dictionary of initial guesses"""
+    return initial_guesses["st_dens"][0] if initial_guesses["berger_dens"] == -1.0\
+        else initial_guesses["berger_dens"][0]
+
+
+class TransitModel():
+    """A transit model for a light curve that is only built and compiled once. It can then be optimised many
+    times from different initial guesses and sampled, without paying for the Theano compilation again.
+
+    The initial guesses set the means of the priors on t0, logP and log_rho_star (through shared data) and
+    the starting point of the optimisation (for every parameter).
 
     Parameters
     ----------
-    lc : :class:`~lightkurve.Lightcurve`
+    lc : :class:`~lightkurve.Lightcurve` or :class:`~compact_lc.CompactLightCurve`
         The lightcurve data
     initial_guesses : `dict`
         Dictionary of initial guesses
-    texp : `float`, optional
-        Exposure time, by default 0.5/24
+    texp : `float` or `np.ndarray`, optional
+        Exposure time in days, either one for every cadence or an array with one per cadence (e.g. for light
+        curves that mix cadences, see :func:`data.estimate_exptimes`), by default 0.5/24. Either way the model
+        is only evaluated (and integrated over the exposure time) for the cadences that are in transit for the
+        current parameters.
     u_init : `list`, optional
         Initial limb darkening guesses, by default [0.3, 0.2]
-
-    Returns
-    -------
-    model
-        PyMC3 model
-    map_soln : `dict`
-        Dictionary of optimised parameters
+    transit_window : `float` or `list`, optional
+        If given, only fit the cadences within this many transit durations (``initial_guesses["pl_trandur"]``)
+        of each transit and bin the rest, see :func:`reduce_to_transit_windows`. Either one value for all
+        planets or one per planet. By default None (fit every cadence). The data are chosen once, using the
+        initial guesses given here, so the window must be wide enough to cover any movement of the transits
+        during the optimisation and sampling (anything outside it is only seen through the bins).
+    bin_size : `float`, optional
+        Size of the bins (in days) for the cadences outside of the transit windows, by default 1.0
     """
-    n_planets = len(initial_guesses["pl_orbper"])
-    t0s_bkjd = Time(initial_guesses["pl_tranmid"], format="jd").bkjd
+    def __init__(self, lc, initial_guesses, texp=0.5 / 24, u_init=[0.3, 0.2], transit_window=None, bin_size=1.0):
+        self.n_planets = len(initial_guesses["pl_orbper"])
+        self.transit_window = transit_window
+        per_cadence = np.ndim(texp) > 0
+        if per_cadence and len(texp) != len(lc):
+            raise ValueError("There must be one exposure time per cadence when `texp` is an array")
+        if transit_window is not None and ("pl_trandur" not in initial_guesses
+                                           or any(dur is None for dur in initial_guesses["pl_trandur"])):
+            raise ValueError("Transit durations (`pl_trandur`) are needed to reduce data to transit windows")
+        with instrument.stage("build_model", n_cadences=len(lc), n_planets=self.n_planets) as record:
+            t0s_bkjd = Time(initial_guesses["pl_tranmid"], format="jd").bkjd
+
+            t, y, yerr = compact_lc.lc_arrays(lc)
+            self.data_mask = None
+            texp = np.asarray(texp, dtype=float) if per_cadence else texp
+            if transit_window is not None:
+                durations = np.asarray(initial_guesses["pl_trandur"]) / 24
+                t, y, yerr, self.data_mask = reduce_to_transit_windows(t, y, yerr, initial_guesses["pl_orbper"],
+                                                                       t0s_bkjd, durations,
+                                                                       transit_window=transit_window,
+                                                                       bin_size=bin_size)
+                if per_cadence:
+                    # the bins are far from any transit so don't need to be integrated over an exposure
+                    texp = np.concatenate((texp[self.data_mask], np.zeros(len(t) - self.data_mask.sum())))
+            self.t = t
+            self.texp = texp
+
+            with pm.Model() as model:
+                # The means of the priors that depend on the initial guesses (these can be updated later)
+                t0_mu = pm.Data("t0_mu", t0s_bkjd)
+                logP_mu = pm.Data("logP_mu", np.log(initial_guesses["pl_orbper"]))
+                log_rho_star_mu = pm.Data("log_rho_star_mu", np.log10(_initial_density(initial_guesses)))
+
+                # The baseline flux
+                mean = pm.Normal("mean", mu=1.0, sd=1.0)
+
+                # The time of a reference transit for each planet
+                t0 = pm.Normal("t0", mu=t0_mu, sd=1.0, shape=self.n_planets)
+
+                # The log period; also tracking the period itself
+                logP = pm.Normal("logP", mu=logP_mu, sd=0.1, shape=self.n_planets)
+                period = pm.Deterministic("period", pm.math.exp(logP))
+
+                # The Kipping (2013) parameterization for quadratic limb darkening parameters
+                limb_dark = xo.distributions.QuadLimbDark("u", testval=u_init)
+
+                r = pm.Uniform(
+                    "r", lower=0.001, upper=0.1, shape=self.n_planets, testval=initial_guesses["pl_ratror"]
+                )
+                b = xo.distributions.ImpactParameter(
+                    "b", ror=r, shape=self.n_planets, testval=initial_guesses["pl_imppar"]
+                )
+
+                # fix stellar density across the stars
+                log_rho_star = pm.Normal("log_rho_star", mu=log_rho_star_mu, sd=1)
+                rho_star = pm.Deterministic("rho_star", 10**(log_rho_star))
+
+                # Set up a Keplerian orbit for the planets
+                orbit = xo.orbits.KeplerianOrbit(period=period, t0=t0, b=b, rho_star=rho_star)
+
+                # Compute the model light curve using starry
+                light_curves = self._light_curves(xo.LimbDarkLightCurve(limb_dark[0], limb_dark[1]), orbit, r)
+                light_curve = pm.math.sum(light_curves, axis=-1) + mean
+
+                # Here we track the value of the model light curve for plotting purposes
+                pm.Deterministic("light_curves", light_curves)
+
+                # The likelihood function assuming known Gaussian uncertainty
+                pm.Normal("obs", mu=light_curve, sd=yerr, observed=y)
+
+            record["n_cadences_fit"] = len(t)
+
+        self.model = model
+        self.u_init = u_init
+        self.set_initial_guesses(initial_guesses)
+
+        # these are compiled the first time that they are needed
+        self._logp_dlogp = None
+        self._point_fn = None
+        self._light_curve_fn = None
+
+    def _light_curves(self, limb_dark_lc, orbit, r):
+        """Build the model light curves of each planet, only evaluating the cadences that are in transit for the
+        current parameters (the rest are zero)
+
+        exoplanet does this itself for a single exposure time, but its check of which cadences are in transit
+        can't take one exposure time per cadence. In that case the cadences are chosen here (padded by the
+        longest exposure time) and each one is integrated over its own exposure time."""
+        if np.ndim(self.texp) == 0:
+            return limb_dark_lc.get_light_curve(orbit=orbit, r=r, t=self.t, texp=self.texp)
+
+        t = tt.as_tensor_variable(self.t)
+        texp = tt.as_tensor_variable(self.texp)
+        inds = orbit.in_transit(t, r=r, texp=float(np.max(self.texp)))
+        in_transit = limb_dark_lc.get_light_curve(orbit=orbit, r=r, t=t[inds], texp=texp[inds],
+                                                  use_in_transit=False)
+        return tt.set_subtensor(tt.zeros((len(self.t), self.n_planets))[inds], in_transit)
+
+    def set_initial_guesses(self, initial_guesses, u_init=None):
+        """Update the prior means and starting point of the optimisation
+
+        Parameters
+        ----------
+        initial_guesses : `dict`
+            Dictionary of initial guesses (needs "pl_orbper", "pl_tranmid", "pl_ratror", "pl_imppar" and the
+            densities)
+        u_init : `list`, optional
+            Initial limb darkening guesses, by default None (keep the current ones)
+        """
+        t0s_bkjd = Time(initial_guesses["pl_tranmid"], format="jd").bkjd
+        logP = np.log(initial_guesses["pl_orbper"])
+        log_rho_star = np.log10(_initial_density(initial_guesses))
+        pm.set_data({"t0_mu": t0s_bkjd, "logP_mu": logP, "log_rho_star_mu": log_rho_star}, model=self.model)
+
+        # start at the prior means and the guesses for everything else (as a fresh model would)
+        if u_init is not None:
+            self.u_init = u_init
+        self.start = self._transformed_point({"mean": 1.0, "t0": t0s_bkjd, "logP": logP,
+                                              "log_rho_star": log_rho_star, "r": initial_guesses["pl_ratror"],
+                                              "b": initial_guesses["pl_imppar"], "u": self.u_init})
+
+    def _transformed_point(self, values, base=None):
+        """Convert values on the original scale into a full point of the model (including transformed values)
+
+        Parameters
+        ----------
+        values : `dict`
+            Values of the model variables, anything missing is taken from the test point. Variables are
+            transformed in order, so the impact parameter should come after the radius ratio (which sets
+            its bounds).
+        base : `dict`, optional
+            Point to update, by default None (the test point)
+
+        Returns
+        -------
+        point : `dict`
+            Point in the model parameter space
+        """
+        point = dict(self.model.test_point if base is None else base)
+        values_so_far = dict(point)
+        for name, value in values.items():
+            value = np.asarray(value, dtype=float)
+            values_so_far[name] = value
+            if name in point:
+                point[name] = value
+                continue
+
+            # otherwise find the transformed variable and apply its transformation
+            for free_RV in self.model.free_RVs:
+                if is_transformed_name(free_RV.name) and get_untransformed_name(free_RV.name) == name:
+                    transformation = self.model.named_vars[name].transformation
+                    point[free_RV.name] = transformation.forward_val(value, point=values_so_far)
+                    break
+        return point
+
+    def _start_point(self, start):
+        """Convert a starting point (on the original or transformed scale) into a full point of the model"""
+        # fill in the free variables that are only tracked as deterministics
+        values = dict(start)
+        if "logP" not in values and "period" in values:
+            values["logP"] = np.log(values["period"])
+        if "log_rho_star" not in values and "rho_star" in values:
+            values["log_rho_star"] = np.log10(values["rho_star"])
+
+        # values on the original scale are transformed (in the order the variables were created)
+        names = [get_untransformed_name(free_RV.name) if is_transformed_name(free_RV.name) else free_RV.name
+                 for free_RV in self.model.free_RVs]
+        point = self._transformed_point({name: values[name] for name in names if name in values}, base=self.start)
+
+        # transformed values are only used directly if there isn't a value on the original scale
+        point.update({key: np.asarray(val, dtype=float) for key, val in start.items()
+                      if key in self.start and is_transformed_name(key) and get_untransformed_name(key) not in values})
+        return point
+
+    def _compile(self):
+        """Compile the log probability, its gradient and the function for the model variables (only once)"""
+        if self._logp_dlogp is None:
+            with instrument.stage("compile"):
+                self._logp_dlogp = self.model.logp_dlogp_function()
+                self._logp_dlogp.set_extra_values({})
+                self._point_fn = self.model.fastfn(self.model.unobserved_RVs)
+
+    def point_values(self, point):
+        """Get the value of every variable (including deterministics) at a point
+
+        Parameters
+        ----------
+        point : `dict`
+            Point in the model parameter space
+
+        Returns
+        -------
+        values : `dict`
+            Dictionary of values, one for each unobserved variable
+        """
+        self._compile()
+        return {var.name: val for var, val in zip(self.model.unobserved_RVs, self._point_fn(point))}
+
+    def optimize(self, initial_guesses=None, u_init=None, start=None, method=None, maxeval=5000, verbose=True):
+        """Find the maximum a posteriori parameters, reusing the compiled model
+
+        Parameters
+        ----------
+        initial_guesses : `dict`, optional
+            New initial guesses, by default None (use the current ones)
+        u_init : `list`, optional
+            New initial limb darkening guesses, by default None (use the current ones)
+        start : `dict`, optional
+            A point from which to start, overrides the initial guesses. Either a point in the model parameter
+            space or values on the original scale (e.g. a previous solution, see :func:`results.find_solution`,
+            or a posterior summary, see :func:`posterior_medians`).
+        method : `str`, optional
+            Which method of ``scipy.optimize.minimize`` to use, by default None (its default)
+        maxeval : `int`, optional
+            Maximum number of evaluations of the log probability, by default 5000
+        verbose : `bool`, optional
+            Whether to print a summary, by default True
 
-    with pm.Model() as model:
+        Returns
+        -------
+        map_soln : `dict`
+            Dictionary of optimised parameters, see :func:`optimise_model`
+        """
+        if initial_guesses is not None:
+            self.set_initial_guesses(initial_guesses, u_init=u_init)
+        elif u_init is not None:
+            self.u_init = u_init
+            self.start = self._transformed_point({"u": u_init}, base=self.start)
+        self._compile()
 
-        # The baseline flux
-        mean = pm.Normal("mean", mu=1.0, sd=1.0)
+        if start is not None:
+            start = self._start_point(start)
+        else:
+            start = self.start
+        x0 = self._logp_dlogp.dict_to_array(start)
 
-        # The time of a reference transit for each planet
-        t0 = pm.Normal("t0", mu=t0s_bkjd, sd=1.0, shape=n_planets)
+        # keep track of the best point, in case the optimiser wanders off somewhere non-finite
+        best = {"x": x0, "logp": -np.inf, "nfev": 0}
+        initial_logp = self._logp_dlogp(x0)[0]
 
-        # The log period; also tracking the period itself
-        logP = pm.Normal("logP", mu=np.log(initial_guesses["pl_orbper"]), sd=0.1, shape=n_planets)
-        period = pm.Deterministic("period", pm.math.exp(logP))
+        def objective(x):
+            logp, dlogp = self._logp_dlogp(x)
+            best["nfev"] += 1
+            if np.isfinite(logp) and logp > best["logp"]:
+                best["x"], best["logp"] = np.copy(x), logp
+            if best["nfev"] >= maxeval:
+                raise StopIteration
+            if not np.isfinite(logp):
+                return np.inf, np.zeros_like(x)
+            return -logp, -dlogp
 
-        # The Kipping (2013) parameterization for quadratic limb darkening parameters
-        limb_dark = xo.distributions.QuadLimbDark("u", testval=u_init)
+        message = "Optimization terminated successfully."
+        with instrument.stage("optimize", n_cadences=len(self.t)) as record:
+            try:
+                result = minimize(objective, x0, jac=True, method=method)
+                message = result.message
+            except StopIteration:
+                message = f"Reached maximum number of evaluations ({maxeval})"
+            record.update({"n_logp_grad_evals": best["nfev"], "logp": float(best["logp"])})
 
-        r = pm.Uniform(
-            "r", lower=0.001, upper=0.1, shape=n_planets, testval=initial_guesses["pl_ratror"]
-        )
-        b = xo.distributions.ImpactParameter(
-            "b", ror=r, shape=n_planets, testval=initial_guesses["pl_imppar"]
-        )
+        self.nfev = best["nfev"]
+        self.logp = float(best["logp"])
+        if verbose:
+            print(f"message: {message}")
+            print(f"logp: {initial_logp} -> {best['logp']} ({best['nfev']} evaluations)")
 
-        initial_dens = initial_guesses["st_dens"][0] if initial_guesses["berger_dens"] == -1.0\
-            else initial_guesses["berger_dens"][0]
+        map_soln = self.point_values(self._logp_dlogp.array_to_full_dict(best["x"]))
 
-        # fix stellar density across the stars
-        log_rho_star = pm.Normal("log_rho_star",
-                                mu=np.log10(initial_dens), sd=1)
-        rho_star = pm.Deterministic("rho_star", 10**(log_rho_star))
+        # keep track of which data were used
+        if self.data_mask is not None:
+            map_soln["data_mask"] = self.data_mask
+            map_soln["data_bin_time"] = self.t[self.data_mask.sum():]
+            map_soln["data_transit_window"] = np.broadcast_to(np.asarray(self.transit_window, dtype=float),
+                                                               (self.n_planets,)).copy()
+        return map_soln
 
-        # Set up a Keplerian orbit for the planets
-        orbit = xo.orbits.KeplerianOrbit(period=period, t0=t0, b=b, rho_star=rho_star)
+    def sample_posteriors(self, map_soln, **kwargs):
+        """Sample the posteriors of the model, see :func:`sample_posteriors`"""
+        return sample_posteriors(self.model, map_soln, **kwargs)
 
-        # Compute the model light curve using starry
-        light_curves = xo.LimbDarkLightCurve(limb_dark[0], limb_dark[1]).get_light_curve(
-            orbit=orbit, r=r, t=lc["time"].value, texp=texp
-        )
-        light_curve = pm.math.sum(light_curves, axis=-1) + mean
+    def _posterior_points(self, trace, chains=None, draws=None):
+        """Iterate over the points of the model parameter space for some draws of a trace
 
-        # Here we track the value of the model light curve for plotting purposes
-        pm.Deterministic("light_curves", light_curves)
+        Parameters
+        ----------
+        trace : :class:`~arviz.InferenceData` or :class:`~xarray.Dataset`
+            Sampled posteriors (or just the posterior group)
+        chains, draws : `list`, optional
+            Which chains and draws to use, by default None (all of them)
 
-        # The likelihood function assuming known Gaussian uncertainty
-        pm.Normal("obs", mu=light_curve, sd=lc["flux_err"].value, observed=lc["flux"].value)
+        Yields
+        ------
+        chain, draw : `int`
+            Which draw this is
+        point : `dict`
+            Point in the model parameter space
+        """
+        posterior = trace.posterior if hasattr(trace, "posterior") else trace
 
-        # Fit for the maximum a posteriori parameters given the simulated dataset
-        map_soln = pmx.optimize(start=model.test_point)
+        # the posterior only has the untransformed variables, in the order that they were created
+        names = [get_untransformed_name(free_RV.name) if is_transformed_name(free_RV.name) else free_RV.name
+                 for free_RV in self.model.free_RVs]
+        samples = {name: posterior[name].values for name in names}
+        n_chains, n_draws = samples[names[0]].shape[:2]
 
-        return map_soln, model
+        chains = range(n_chains) if chains is None else chains
+        draws = range(n_draws) if draws is None else draws
+        for chain in chains:
+            for draw in draws:
+                yield chain, draw, self._transformed_point({name: samples[name][chain, draw] for name in names})
+
+    def _time_bins(self, bin_size):
+        """Work out which bin (of width ``bin_size`` days) each of the model times falls in
+
+        Returns
+        -------
+        bin_inds : `np.ndarray`
+            Index of the bin of each time
+        bin_time : `np.ndarray`
+            Mean time of each (non-empty) bin
+        counts : `np.ndarray`
+            Number of times in each bin
+        """
+        bins = np.floor((self.t - self.t.min()) / bin_size).astype(int)
+        _, bin_inds, counts = np.unique(bins, return_inverse=True, return_counts=True)
+        bin_time = np.bincount(bin_inds, weights=self.t) / counts
+        return bin_inds, bin_time, counts
+
+    def light_curves(self, trace, chains=None, draws=None, bin_size=None):
+        """Rebuild the model light curves of some draws of the posteriors
+
+        This allows sampling without storing the "light_curves" of every draw (see :func:`sample_posteriors`)
+        and then only computing the ones that are needed afterwards.
+
+        Parameters
+        ----------
+        trace : :class:`~arviz.InferenceData` or :class:`~xarray.Dataset`
+            Sampled posteriors (or just the posterior group)
+        chains, draws : `list`, optional
+            Which chains and draws to use, by default None (all of them)
+        bin_size : `float`, optional
+            Average the light curves in bins of this many days, by default None (no binning)
+
+        Returns
+        -------
+        time : `np.ndarray`
+            The times of the model light curves (the bin times if ``bin_size`` is given)
+        light_curves : `np.ndarray`
+            Model light curve of each planet, with shape (chains, draws, times, planets)
+        """
+        posterior = trace.posterior if hasattr(trace, "posterior") else trace
+        chains = list(range(posterior.dims["chain"]) if chains is None else chains)
+        draws = list(range(posterior.dims["draw"]) if draws is None else draws)
+
+        time, bin_inds, counts = self.t, None, None
+        if bin_size is not None:
+            bin_inds, time, counts = self._time_bins(bin_size)
+
+        light_curves = np.zeros((len(chains), len(draws), len(time), self.n_planets))
+        for i, (_, _, light_curve) in enumerate(self._iter_light_curves(posterior, chains, draws, bin_inds, counts)):
+            light_curves[i // len(draws), i % len(draws)] = light_curve
+        return time, light_curves
+
+    def _iter_light_curves(self, trace, chains, draws, bin_inds=None, counts=None):
+        """Iterate over the (optionally binned) model light curves of some draws of the posteriors"""
+        if self._light_curve_fn is None:
+            self._light_curve_fn = self.model.fastfn(self.model.named_vars["light_curves"])
+
+        for chain, draw, point in self._posterior_points(trace, chains, draws):
+            light_curve = self._light_curve_fn(point)
+            if bin_inds is not None:
+                light_curve = np.stack([np.bincount(bin_inds, weights=light_curve[:, i]) / counts
+                                        for i in range(self.n_planets)], axis=-1)
+            yield chain, draw, light_curve
+
+    def save_light_curves(self, trace, path, thin=1, bin_size=None, dtype=np.float32):
+        """Rebuild the model light curves of the posteriors and stream them to disk one draw at a time
+
+        The light curves are saved in ``path`` as "light_curves.npy" (with shape (chains, draws, times, planets)),
+        along with "time.npy" and "draw.npy" (which draws were kept). These can then be memory-mapped with
+        ``np.load(..., mmap_mode="r")`` to avoid ever holding every light curve in memory.
+
+        Parameters
+        ----------
+        trace : :class:`~arviz.InferenceData` or :class:`~xarray.Dataset`
+            Sampled posteriors (or just the posterior group)
+        path : `str`
+            Folder in which to save the light curves
+        thin : `int`, optional
+            Only save every ``thin``-th draw, by default 1 (every draw)
+        bin_size : `float`, optional
+            Average the light curves in bins of this many days, by default None (no binning)
+        dtype : `type`, optional
+            Data type of the saved light curves, by default np.float32
+        """
+        posterior = trace.posterior if hasattr(trace, "posterior") else trace
+        chains = list(range(posterior.dims["chain"]))
+        draws = list(range(0, posterior.dims["draw"], thin))
+
+        time, bin_inds, counts = self.t, None, None
+        if bin_size is not None:
+            bin_inds, time, counts = self._time_bins(bin_size)
+
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "time.npy"), time)
+        np.save(os.path.join(path, "draw.npy"), np.array(draws))
+        light_curves = np.lib.format.open_memmap(os.path.join(path, "light_curves.npy"), mode="w+", dtype=dtype,
+                                                 shape=(len(chains), len(draws), len(time), self.n_planets))
+        for i, (_, _, light_curve) in enumerate(self._iter_light_curves(posterior, chains, draws,
+                                                                        bin_inds, counts)):
+            light_curves[i // len(draws), i % len(draws)] = light_curve
+        light_curves.flush()
+        del light_curves
+
+
+def optimise_model(lc, initial_guesses, texp=0.5 / 24, u_init=[0.3, 0.2], transit_window=None, bin_size=1.0,
+                   start=None):
+    """Optimise a transit model to fit some data
+
+    This builds a new model each time, use :class:`TransitModel` directly to optimise the same model many times.
+
+    Parameters
+    ----------
+    lc : :class:`~lightkurve.Lightcurve` or :class:`~compact_lc.CompactLightCurve`
+        The lightcurve data
+    initial_guesses : `dict`
+        Dictionary of initial guesses
+    texp : `float` or `np.ndarray`, optional
+        Exposure time in days, either one for every cadence or one per cadence, by default 0.5/24
+    u_init : `list`, optional
+        Initial limb darkening guesses, by default [0.3, 0.2]
+    transit_window : `float` or `list`, optional
+        If given, only fit the cadences within this many transit durations (``initial_guesses["pl_trandur"]``)
+        of each transit and bin the rest, see :func:`reduce_to_transit_windows`. Either one value for all
+        planets or one per planet. By default None (fit every cadence).
+    bin_size : `float`, optional
+        Size of the bins (in days) for the cadences outside of the transit windows, by default 1.0
+    start : `dict`, optional
+        Warm-start the optimisation from a previous solution or posterior summary (see
+        :meth:`TransitModel.optimize`), by default None (start from the initial guesses)
+
+    Returns
+    -------
+    model
+        PyMC3 model
+    map_soln : `dict`
+        Dictionary of optimised parameters. If ``transit_window`` is given then this also records the data that
+        were used: "data_mask" (which cadences of ``lc`` were used, these come first in "light_curves"),
+        "data_bin_time" (times of the bins that follow them) and "data_transit_window".
+    """
+    transit_model = TransitModel(lc, initial_guesses, texp=texp, u_init=u_init, transit_window=transit_window,
+                                 bin_size=bin_size)
+    map_soln = transit_model.optimize(start=start)
+    return map_soln, transit_model.model
+
+
+def posterior_medians(trace):
+    """Summarise sampled posteriors by the median of each variable (e.g. to warm-start a later optimisation)
+
+    Parameters
+    ----------
+    trace : :class:`~arviz.InferenceData` or :class:`~xarray.Dataset`
+        Sampled posteriors (or just the posterior group)
+
+    Returns
+    -------
+    medians : `dict`
+        Median of each variable (except the model light curves) over every chain and draw
+    """
+    posterior = trace.posterior if hasattr(trace, "posterior") else trace
+    return {name: posterior[name].median(dim=("chain", "draw")).values
+            for name in posterior.data_vars if name != "light_curves"}
     
 
-def sample_posteriors(model, map_soln, tune=1000, draws=1000, cores=6, chains=2):
+def minimum_ess(trace, var_names=None):
+    """Get the smallest effective sample size of any element of any variable in a trace
+
+    Parameters
+    ----------
+    trace : :class:`~arviz.InferenceData`
+        Sampled posteriors
+    var_names : `list`, optional
+        Which variables to consider, by default None (all of them)
+
+    Returns
+    -------
+    min_ess : `float`
+        The smallest effective sample size
+    """
+    return float(az.ess(trace, var_names=var_names).to_array().min())
+
+
+def sample_posteriors(model, map_soln, tune=1000, draws=1000, cores=None, chains=None, target_ess=None,
+                      store_light_curves=True, log_likelihood=True, trace_file=None):
     """Sample the posteriors of a given model
 
+    The "light_curves" deterministic (and the log likelihood) has a value for every cadence, so storing it for
+    every draw can take far more memory than the rest of the trace. Setting ``store_light_curves=False`` and
+    ``log_likelihood=False`` keeps the trace small, and the light curves of any draws can be rebuilt afterwards
+    with :meth:`TransitModel.light_curves` or streamed to disk with :meth:`TransitModel.save_light_curves`.
+
     Parameters
     ----------
     model
-        PyMC3 Model
+        PyMC3 Model (or :class:`TransitModel`)
     map_soln : `dict`
         Dictionary of optimised parameters
     tune : `int`, optional
         How many tuning steps, by default 1000
     draws : `int`, optional
-        How many draws, by default 1000
+        How many draws per chain, by default 1000 (ignored if ``target_ess`` is given)
     cores : `int`, optional
-        How many cores to use, by default 6
+        How many chains to run at once, by default None (as many as the available CPUs and thread limits allow,
+        see :func:`resources.plan_sampling`)
     chains : `int`, optional
-        How many chains to run, by default 2
+        How many chains to run, by default None (at least 2, one per available core)
+    target_ess : `float`, optional
+        Run more, shorter chains in parallel with enough draws in total to reach roughly this effective sample
+        size, by default None
+    store_light_curves : `bool`, optional
+        Whether to store the "light_curves" deterministic for each draw, by default True
+    log_likelihood : `bool`, optional
+        Whether to store the log likelihood of each cadence for each draw, by default True
+    trace_file : `str`, optional
+        Path at which to save the trace as NetCDF once sampling is done, by default None (don't save it)
 
     Returns
     -------
     trace
-        Sampled posteriors
+        Sampled posteriors, the sampling plan and achieved effective samples per second are saved in
+        ``trace.sample_stats.attrs``
     """
-    with model:
-        trace = pmx.sample(
-            tune=tune,
-            draws=draws,
-            start=map_soln,
-            cores=cores,
-            chains=chains,
-            target_accept=0.9,
-            return_inferencedata=True,
-        )
-    return trace
\ No newline at end of file
+    model = model.model if isinstance(model, TransitModel) else model
+    plan = resources.plan_sampling(draws=draws, chains=chains, cores=cores, target_ess=target_ess)
+    print(f"Sampling {plan['chains']} chains of {plan['draws']} draws, {plan['cores']} at a time "
+          f"({plan['threads']} threads each, {plan['n_cpus']} CPUs available)")
+
+    # only pass on the model variables (the solution may also say which data were used)
+    start = {key: val for key, val in map_soln.items() if key in model.named_vars}
+
+    # None tracks every variable
+    track = None if store_light_curves else [var for var in model.unobserved_RVs if var.name != "light_curves"]
+
+    with model, instrument.stage("sample", tune=tune, **plan) as record:
+        start_time = time.perf_counter()
+
+        # the BLAS/OpenMP thread pools are already set up by now, so environment variables would do nothing.
+        # Instead the pools of this process are limited directly while sampling, and the forked chains start
+        # with the same limits (they are put back when sampling finishes).
+        with threadpool_limits(limits=plan["threads"]):
+            trace = pmx.sample(
+                tune=tune,
+                draws=plan["draws"],
+                start=start,
+                cores=plan["cores"],
+                chains=plan["chains"],
+                target_accept=0.9,
+                trace=track,
+                return_inferencedata=True,
+                idata_kwargs={"log_likelihood": log_likelihood},
+            )
+
+        # each leapfrog step of NUTS is one evaluation of the log probability and its gradient
+        if "tree_size" in trace.sample_stats:
+            record["n_logp_grad_evals"] = int(trace.sample_stats["tree_size"].sum())
+
+        # judge the sampling by its slowest mixing parameter
+        wall_time = time.perf_counter() - start_time
+        var_names = [get_untransformed_name(var.name) if is_transformed_name(var.name) else var.name
+                     for var in model.free_RVs]
+        min_ess = minimum_ess(trace, var_names=var_names)
+        record.update({"min_ess": min_ess, "ess_per_second": min_ess / wall_time})
+        trace.sample_stats.attrs.update({**{f"plan_{key}": val for key, val in plan.items()},
+                                         "sampling_time": wall_time, "min_ess": min_ess,
+                                         "ess_per_second": min_ess / wall_time})
+        print(f"Minimum ESS: {min_ess:.0f} in {wall_time:.1f}s ({min_ess / wall_time:.2f} per second)")
+
+    if trace_file is not None:
+        trace.to_netcdf(trace_file)
+    return trace
@@ -0,0 +1,145 @@
+import cProfile
+import json
+import os
+import resource
+import tempfile
+import time
+
+from contextlib import contextmanager
+
+# stages to profile, e.g. PROFILE_STAGES="pld,optimize" (or "all")
+PROFILE_STAGES = [stage for stage in os.environ.get("PROFILE_STAGES", "").split(",") if stage != ""]
+
+# the collector that stages are currently being recorded to (None when nobody is listening)
+_active = None
+
+
+def _peak_rss_mb():
+    """Get the peak resident set size (in MB) of this process and of its finished children so far"""
+    # ru_maxrss is in kB on Linux
+    return {"peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            "peak_rss_children_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024}
+
+
+def _cpu_time():
+    """Get the CPU time (user + system, in seconds) used by this process and its finished children so far"""
+    children = os.times()
+    return time.process_time() + children.children_user + children.children_system
+
+
+class Metrics():
+    """Collects the timing and memory usage of each stage of a run
+
+    Parameters
+    ----------
+    name : `str`, optional
+        Name of the run (e.g. the system), by default None
+    profile_stages : `list`, optional
+        Names of stages to run with cProfile (or ["all"]), by default None (use ``PROFILE_STAGES``)
+    profile_dir : `str`, optional
+        Folder in which to save the profiles, by default "."
+    """
+    def __init__(self, name=None, profile_stages=None, profile_dir="."):
+        self.name = name
+        self.profile_stages = PROFILE_STAGES if profile_stages is None else profile_stages
+        self.profile_dir = profile_dir
+        self.stages = []
+        self._stack = []
+        self._profiling = False
+
+    def __enter__(self):
+        global _active
+        self._previous = _active
+        _active = self
+        return self
+
+    def __exit__(self, *args):
+        global _active
+        _active = self._previous
+
+    @contextmanager
+    def stage(self, stage_name, **info):
+        """Record a stage, see :func:`stage`"""
+        record = {"stage": "/".join(self._stack + [stage_name]), **info}
+        self._stack.append(stage_name)
+
+        profiler = None
+        if not self._profiling and (stage_name in self.profile_stages or "all" in self.profile_stages):
+            profiler = cProfile.Profile()
+            self._profiling = True
+            profiler.enable()
+
+        wall_start, cpu_start = time.perf_counter(), _cpu_time()
+        try:
+            yield record
+        finally:
+            record["wall_time"] = time.perf_counter() - wall_start
+            record["cpu_time"] = _cpu_time() - cpu_start
+            record.update(_peak_rss_mb())
+            self._stack.pop()
+            self.stages.append(record)
+
+            if profiler is not None:
+                profiler.disable()
+                self._profiling = False
+                prefix = "" if self.name is None else f"{self.name.rstrip()}-"
+                path = os.path.join(self.profile_dir, f"{prefix}{record['stage'].replace('/', '-')}.prof")
+                profiler.dump_stats(path)
+                record["profile"] = path
+
+    def totals(self):
+        """Sum the wall and CPU times of the stages with the same name
+
+        Returns
+        -------
+        totals : `dict`
+            Dictionary of {"wall_time", "cpu_time", "count"} for each stage name
+        """
+        totals = {}
+        for record in self.stages:
+            total = totals.setdefault(record["stage"], {"wall_time": 0.0, "cpu_time": 0.0, "count": 0})
+            total["wall_time"] += record["wall_time"]
+            total["cpu_time"] += record["cpu_time"]
+            total["count"] += 1
+        return totals
+
+    def save(self, path):
+        """Save the metrics to a JSON file (atomically)
+
+        Parameters
+        ----------
+        path : `str`
+            Path at which to save the metrics
+        """
+        output = {"name": self.name, "stages": self.stages, "totals": self.totals(), **_peak_rss_mb()}
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(output, f, indent=1, default=float)
+        os.replace(tmp_path, path)
+
+
+@contextmanager
+def stage(stage_name, **info):
+    """Record the wall time, CPU time and peak memory of a stage to the active :class:`Metrics` (if there is one)
+
+    The yielded dictionary can be used to add any other information about the stage, e.g. the number of
+    cadences. Stages can be nested, in which case their names are joined with "/".
+
+    Parameters
+    ----------
+    stage_name : `str`
+        Name of the stage
+    **info
+        Any other information to record
+
+    Examples
+    --------
+    Record a stage and the amount of data that it processed::
+        with instrument.stage("remove_outliers") as record:
+            record["n_cadences"] = len(lc)
+    """
+    if _active is None:
+        yield dict(info)
+    else:
+        with _active.stage(stage_name, **info) as record:
+            yield record
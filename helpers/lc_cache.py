@@ -0,0 +1,224 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+# each entry is a directory of .npy files (one per array) and a JSON file of metadata
+LC_CACHE_DIR = os.environ.get("LC_CACHE_DIR",
+                              os.path.join(os.path.expanduser("~"), ".cache", "radius-valley", "lightcurves"))
+META_FILE = "meta.json"
+
+
+def cache_key(**settings):
+    """Work out the content address of a cache entry from the settings used to create it
+
+    Parameters
+    ----------
+    **settings
+        Any JSON-serialisable settings, e.g. target name, mission, exposure time, PLD and flattening settings
+
+    Returns
+    -------
+    key : `str`
+        Hex digest identifying the entry
+    """
+    return hashlib.sha1(json.dumps(settings, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _entry_path(key):
+    """Get the directory of a cache entry"""
+    return os.path.join(LC_CACHE_DIR, key)
+
+
+def _checksum(path):
+    """Get the SHA1 checksum of a file"""
+    sha = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def save_entry(key, arrays, meta=None):
+    """Save a collection of arrays to the cache
+
+    The entry is written to a temporary directory and then renamed into place so that other jobs never see
+    a partially written entry. If someone else finishes writing the same entry first then theirs is kept.
+
+    Parameters
+    ----------
+    key : `str`
+        Key of the entry, see :func:`cache_key`
+    arrays : `dict`
+        Dictionary of arrays to save
+    meta : `dict`, optional
+        JSON-serialisable metadata to save alongside the arrays, by default None
+    """
+    os.makedirs(LC_CACHE_DIR, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=LC_CACHE_DIR, prefix=".tmp-")
+    try:
+        checksums = {}
+        for name, array in arrays.items():
+            path = os.path.join(tmp_dir, name + ".npy")
+            np.save(path, np.ascontiguousarray(array))
+            checksums[name] = _checksum(path)
+
+        with open(os.path.join(tmp_dir, META_FILE), "w") as f:
+            json.dump({"key": key, "created": time.time(), "checksums": checksums,
+                       "meta": {} if meta is None else meta}, f)
+
+        os.rename(tmp_dir, _entry_path(key))
+    except OSError:
+        # most likely another job beat us to it, either way the cache is just an optimisation
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def load_entry(key, mmap=True):
+    """Load an entry from the cache
+
+    Parameters
+    ----------
+    key : `str`
+        Key of the entry, see :func:`cache_key`
+    mmap : `bool`, optional
+        Whether to memory-map the arrays (read-only) rather than read them into memory, by default True
+
+    Returns
+    -------
+    arrays : `dict` or `None`
+        Dictionary of arrays, or None if the entry isn't in the cache
+    meta : `dict` or `None`
+        Metadata saved with the arrays, or None if the entry isn't in the cache
+    """
+    path = _entry_path(key)
+    try:
+        with open(os.path.join(path, META_FILE), "r") as f:
+            info = json.load(f)
+        arrays = {name: np.load(os.path.join(path, name + ".npy"), mmap_mode="r" if mmap else None)
+                  for name in info["checksums"]}
+    except (OSError, ValueError):
+        return None, None
+
+    # record the access so that pruning removes the least recently used entries first
+    try:
+        os.utime(os.path.join(path, META_FILE))
+    except OSError:
+        pass
+    return arrays, info["meta"]
+
+
+def list_entries():
+    """List every entry in the cache
+
+    Returns
+    -------
+    entries : `list`
+        A list of dictionaries (one per entry) containing the "key", its "meta"data, its "size" in bytes and
+        when it was "created" and "last_used" (as Unix times), sorted from least to most recently used
+    """
+    if not os.path.isdir(LC_CACHE_DIR):
+        return []
+
+    entries = []
+    for key in os.listdir(LC_CACHE_DIR):
+        path = _entry_path(key)
+        meta_path = os.path.join(path, META_FILE)
+        if key.startswith(".tmp-") or not os.path.exists(meta_path):
+            continue
+        try:
+            with open(meta_path, "r") as f:
+                info = json.load(f)
+            size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+            last_used = os.path.getmtime(meta_path)
+        except (OSError, ValueError):
+            continue
+        entries.append({"key": key, "meta": info["meta"], "size": size,
+                        "created": info["created"], "last_used": last_used})
+    return sorted(entries, key=lambda entry: entry["last_used"])
+
+
+def remove_entry(key):
+    """Remove an entry from the cache
+
+    Parameters
+    ----------
+    key : `str`
+        Key of the entry
+    """
+    shutil.rmtree(_entry_path(key), ignore_errors=True)
+
+
+def prune(max_size=None, max_age=None):
+    """Remove entries from the cache until it satisfies some size and age limits
+
+    Parameters
+    ----------
+    max_size : `int`, optional
+        Maximum total size of the cache in bytes, the least recently used entries are removed first,
+        by default None (no limit)
+    max_age : `float`, optional
+        Remove any entry that hasn't been used for this many seconds, by default None (no limit)
+
+    Returns
+    -------
+    removed : `list`
+        Keys of the entries that were removed
+    """
+    entries = list_entries()
+    removed = []
+
+    if max_age is not None:
+        now = time.time()
+        for entry in entries:
+            if now - entry["last_used"] > max_age:
+                remove_entry(entry["key"])
+                removed.append(entry["key"])
+        entries = [entry for entry in entries if entry["key"] not in removed]
+
+    if max_size is not None:
+        total = sum(entry["size"] for entry in entries)
+        for entry in entries:
+            if total <= max_size:
+                break
+            remove_entry(entry["key"])
+            removed.append(entry["key"])
+            total -= entry["size"]
+    return removed
+
+
+def verify(keys=None, remove=False):
+    """Check that cache entries are complete and their arrays match the checksums saved when they were written
+
+    Parameters
+    ----------
+    keys : `list`, optional
+        Which entries to check, by default None (check every entry)
+    remove : `bool`, optional
+        Whether to remove any entries that fail, by default False
+
+    Returns
+    -------
+    bad_keys : `list`
+        Keys of the entries that failed
+    """
+    keys = [entry["key"] for entry in list_entries()] if keys is None else keys
+    bad_keys = []
+    for key in keys:
+        path = _entry_path(key)
+        try:
+            with open(os.path.join(path, META_FILE), "r") as f:
+                info = json.load(f)
+            ok = all(_checksum(os.path.join(path, name + ".npy")) == checksum
+                     for name, checksum in info["checksums"].items())
+        except (OSError, ValueError, KeyError):
+            ok = False
+
+        if not ok:
+            bad_keys.append(key)
+            if remove:
+                remove_entry(key)
+    return bad_keys
@@ -0,0 +1,113 @@
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+import xo_archive
+
+
+def read_systems_file(file_name, strip_names=True):
+    """Read a file of system IDs and names (one "ID,name" pair per line)
+
+    Parameters
+    ----------
+    file_name : `str`
+        Path to the systems file
+    strip_names : `bool`, optional
+        Whether to remove whitespace around the names, by default True. Note that a trailing space is what stops
+        an archive search for "Kepler-5 " matching Kepler-50 etc. (see :func:`xo_archive.get_exoplanet_parameters`)
+
+    Returns
+    -------
+    systems : `dict`
+        Dictionary mapping each system ID to its name
+    """
+    systems = {}
+    with open(file_name, "r") as f:
+        for line in f:
+            if line.strip() == "":
+                continue
+            sys_id, sys_name = line.split(",")
+            systems[int(sys_id)] = sys_name.strip() if strip_names else sys_name.replace("\n", "")
+    return systems
+
+
+def write_manifest(systems_file, manifest_file, which="composite", **query_kwargs):
+    """Prefetch the parameters of every system in a systems file and save them to a single manifest
+
+    The manifest is a table with one row per planet, along with the "system_id" and "system_name" that it
+    belongs to, and includes the Berger+2023 densities so that no other lookups are needed during fits.
+
+    Parameters
+    ----------
+    systems_file : `str`
+        Path to the systems file, see :func:`read_systems_file`
+    manifest_file : `str`
+        Path at which to save the manifest
+    which : `str`, optional
+        Which table of parameters to draw from, see :func:`xo_archive.get_exoplanet_parameters`,
+        by default "composite"
+    **query_kwargs
+        Any other arguments for :func:`xo_archive.get_bulk_exoplanet_parameters`
+
+    Returns
+    -------
+    manifest : :class:`~pandas.DataFrame`
+        The manifest that was saved
+    """
+    systems = read_systems_file(systems_file)
+    parameters = xo_archive.get_bulk_exoplanet_parameters(list(systems.values()), which=which, **query_kwargs)
+
+    rows = []
+    for sys_id, sys_name in systems.items():
+        if len(parameters[sys_name]) == 0:
+            print(f"Warning: no planets found for system {sys_id} ({sys_name})")
+        for planet in parameters[sys_name]:
+            rows.append({"system_id": sys_id, "system_name": sys_name, **planet})
+    manifest = pd.DataFrame(rows)
+
+    # write to a temporary file first so that nobody reads a half-written manifest
+    directory = os.path.dirname(os.path.abspath(manifest_file))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        manifest.to_csv(f, index=False)
+    os.replace(tmp_path, manifest_file)
+    return manifest
+
+
+def read_manifest(manifest_file, system_id=None):
+    """Read the planetary parameters from a manifest
+
+    Parameters
+    ----------
+    manifest_file : `str`
+        Path to the manifest, see :func:`write_manifest`
+    system_id : `int`, optional
+        Which system to get, by default None (get the whole manifest)
+
+    Returns
+    -------
+    parameters : `list` or :class:`~pandas.DataFrame`
+        If a ``system_id`` is given then a list of dictionaries (one per planet) exactly like the output of
+        :func:`xo_archive.get_exoplanet_parameters`, otherwise the whole manifest
+
+    Raises
+    ------
+    ValueError
+        If the system is not in the manifest
+    """
+    manifest = pd.read_csv(manifest_file)
+    if system_id is None:
+        return manifest
+
+    rows = manifest[manifest["system_id"] == system_id].drop(columns=["system_id", "system_name"])
+    if len(rows) == 0:
+        raise ValueError(f"Unknown system ID: {system_id} is not in {manifest_file}")
+
+    # missing values come back from the archive as None rather than NaN
+    rows = rows.astype(object).where(rows.notna(), None)
+    parameters = rows.to_dict(orient="records")
+    for planet in parameters:
+        planet["berger_dens"] = np.float64(planet["berger_dens"])
+    return parameters
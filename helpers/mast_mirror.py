@@ -0,0 +1,191 @@
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+# the stand-in server for testing can be used by setting this environment variable
+DOWNLOAD_URL = os.environ.get("MAST_DOWNLOAD_URL", "https://mast.stsci.edu/api/v0.1/Download/file")
+
+# shared local copy of MAST products (and the search results that found them), e.g. on a group file system
+MIRROR_DIR = os.environ.get("MAST_MIRROR_DIR",
+                            os.path.join(os.path.expanduser("~"), ".cache", "radius-valley", "mast"))
+
+# when offline, searches and products are only resolved from the mirror
+OFFLINE = os.environ.get("MAST_OFFLINE", "0") == "1"
+
+# maximum number of files to download at once
+MAX_DOWNLOADS = 4
+
+# each download thread keeps its own session so connections are reused between files
+_sessions = threading.local()
+
+
+def _session():
+    """Get the requests session of this thread"""
+    if not hasattr(_sessions, "session"):
+        _sessions.session = requests.Session()
+    return _sessions.session
+
+
+def _search_path(name, mission, exptime):
+    """Path of the saved results of a search in the mirror"""
+    key = hashlib.sha1(json.dumps({"name": name.strip().lower(), "mission": mission, "exptime": exptime},
+                                  sort_keys=True, default=str).encode()).hexdigest()
+    return os.path.join(MIRROR_DIR, "searches", key + ".json")
+
+
+def product_path(product):
+    """Path of a product in the mirror
+
+    Parameters
+    ----------
+    product : `dict`
+        Product found by :func:`search_products` (needs "obs_collection" and "productFilename")
+
+    Returns
+    -------
+    path : `str`
+        Path of the file
+    """
+    return os.path.join(MIRROR_DIR, "files", product["obs_collection"], product["productFilename"])
+
+
+def _atomic_write_json(path, contents):
+    """Write a JSON file atomically"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(contents, f)
+    os.replace(tmp_path, path)
+
+
+def search_products(name, mission=None, exptime=None, offline=None):
+    """Search MAST for the TargetPixelFiles of a target, saving the results in the mirror
+
+    Parameters
+    ----------
+    name : `str`
+        Target name, see :func:`data.get_flattened_lc`
+    mission : `str`, optional
+        Which mission to search, by default None (any)
+    exptime : `int` or `str`, optional
+        Exposure time of the products, see :func:`data.get_flattened_lc`, by default None (any)
+    offline : `bool`, optional
+        Whether to only use searches saved in the mirror, by default None (which uses ``OFFLINE``)
+
+    Returns
+    -------
+    products : `list`
+        A list of dictionaries (one per product, in the order lightkurve would download them) with the
+        "dataURI", "productFilename", "obs_collection", "mission" and "exptime" of each
+
+    Raises
+    ------
+    LookupError
+        If working offline and the search is not in the mirror
+    """
+    offline = OFFLINE if offline is None else offline
+    path = _search_path(name, mission, exptime)
+
+    if offline:
+        try:
+            with open(path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            raise LookupError(f"Working offline and the search for {name.strip()} (mission={mission}, "
+                              f"exptime={exptime}) is not in the MAST mirror ({MIRROR_DIR})")
+
+    import lightkurve as lk
+    table = lk.search_targetpixelfile(name, mission=mission, exptime=exptime).table
+    products = [{"dataURI": str(row["dataURI"]), "productFilename": str(row["productFilename"]),
+                 "obs_collection": str(row["obs_collection"]),
+                 "mission": str(row["mission"]) if "mission" in table.colnames else None,
+                 "exptime": float(row["exptime"]) if "exptime" in table.colnames else None} for row in table]
+    _atomic_write_json(path, products)
+    return products
+
+
+def download_product(product, offline=None):
+    """Download a product into the mirror (unless it is already there)
+
+    A lock is held on the file while it is downloaded, so if several jobs want the same product then only the
+    first one downloads it and the others wait for it to finish.
+
+    Parameters
+    ----------
+    product : `dict`
+        Product found by :func:`search_products`
+    offline : `bool`, optional
+        Whether to only use the mirror, by default None (which uses ``OFFLINE``)
+
+    Returns
+    -------
+    path : `str`
+        Path of the product in the mirror
+
+    Raises
+    ------
+    LookupError
+        If working offline and the product is not in the mirror
+    """
+    offline = OFFLINE if offline is None else offline
+    path = product_path(product)
+    if os.path.exists(path):
+        return path
+    if offline:
+        raise LookupError(f"Working offline and {product['productFilename']} is not in the MAST mirror")
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            # someone else may have downloaded it while we were waiting
+            if os.path.exists(path):
+                return path
+
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f, _session().get(DOWNLOAD_URL, params={"uri": product["dataURI"]},
+                                                               stream=True, timeout=300) as r:
+                    r.raise_for_status()
+                    for chunk in r.iter_content(chunk_size=1 << 20):
+                        f.write(chunk)
+                os.replace(tmp_path, path)
+            except BaseException:
+                # don't leave half-downloaded files lying around
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    return path
+
+
+def download_products(products, max_downloads=None, offline=None):
+    """Download several products into the mirror at once
+
+    Parameters
+    ----------
+    products : `list`
+        Products found by :func:`search_products`
+    max_downloads : `int`, optional
+        Maximum number of files to download at once, by default None (which uses ``MAX_DOWNLOADS``)
+    offline : `bool`, optional
+        Whether to only use the mirror, by default None (which uses ``OFFLINE``)
+
+    Returns
+    -------
+    paths : `list`
+        Paths of the products in the mirror (in the same order as ``products``)
+    """
+    max_downloads = MAX_DOWNLOADS if max_downloads is None else max_downloads
+    if max_downloads <= 1 or len(products) <= 1:
+        return [download_product(product, offline=offline) for product in products]
+    with ThreadPoolExecutor(max_workers=min(max_downloads, len(products))) as executor:
+        return list(executor.map(lambda product: download_product(product, offline=offline), products))
@@ -0,0 +1,116 @@
+import os
+
+import numpy as np
+
+# environment variables that control how many threads numpy/BLAS (and Theano's OpenMP ops) use
+THREAD_VARIABLES = ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"]
+
+
+def available_cpus():
+    """Work out how many CPUs this process may use
+
+    Inside a SLURM job this is the number of CPUs allocated on this node, otherwise it is the number of CPUs in
+    the affinity mask of the process (which also respects any cgroup/taskset limits).
+
+    Returns
+    -------
+    n_cpus : `int`
+        Number of available CPUs
+    """
+    try:
+        n_cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        n_cpus = os.cpu_count() or 1
+
+    for var in ["SLURM_CPUS_ON_NODE", "SLURM_JOB_CPUS_PER_NODE"]:
+        # SLURM_JOB_CPUS_PER_NODE can look like "16(x2)", take the count for this node
+        value = os.environ.get(var, "").split("(")[0].split(",")[0]
+        if value.isdigit():
+            return max(1, min(n_cpus, int(value)))
+    return n_cpus
+
+
+def thread_limits():
+    """Get the thread limits set for BLAS and Theano
+
+    Returns
+    -------
+    limits : `dict`
+        The value of each of ``THREAD_VARIABLES`` (None if it isn't set) and "theano_openmp" (whether Theano
+        has been told to use OpenMP through ``THEANO_FLAGS``)
+    """
+    limits = {}
+    for var in THREAD_VARIABLES:
+        value = os.environ.get(var, "")
+        limits[var] = int(value) if value.isdigit() else None
+
+    flags = dict(flag.split("=", 1) for flag in os.environ.get("THEANO_FLAGS", "").split(",") if "=" in flag)
+    limits["theano_openmp"] = flags.get("openmp", "False").lower() in ["true", "1"]
+    return limits
+
+
+def set_thread_limits(threads):
+    """Limit the number of threads used by BLAS and Theano in this process's children
+
+    These only take effect in processes that import numpy after they are set (e.g. freshly spawned workers).
+
+    Parameters
+    ----------
+    threads : `int`
+        Number of threads
+    """
+    for var in THREAD_VARIABLES:
+        os.environ[var] = str(threads)
+
+
+def plan_sampling(draws=1000, chains=None, cores=None, threads=None, target_ess=None, ess_per_draw=0.5,
+                  min_draws=200, n_cpus=None):
+    """Choose how many chains to run, how many at once, how many threads each gets and how long they are
+
+    Without a ``target_ess``, every available CPU runs a chain (at least 2 chains) of ``draws`` draws. With a
+    ``target_ess``, the effective samples are split over as many parallel chains as possible so that each chain
+    can be shorter (down to ``min_draws``), which reaches the target sooner. Note that each chain still has to
+    be tuned, so very short chains waste most of their time tuning.
+
+    Parameters
+    ----------
+    draws : `int`, optional
+        Draws per chain when there is no ``target_ess``, by default 1000
+    chains : `int`, optional
+        Number of chains, by default None (choose automatically)
+    cores : `int`, optional
+        Number of chains to run at once, by default None (choose automatically)
+    threads : `int`, optional
+        Threads for each chain, by default None. Without OpenMP every Theano op of a chain runs on one thread,
+        so this is 1 unless Theano has been told to use OpenMP (see :func:`thread_limits`), in which case it is
+        the BLAS/OpenMP thread limit (or 1 if that isn't set).
+    target_ess : `float`, optional
+        Total effective sample size to aim for, by default None
+    ess_per_draw : `float`, optional
+        Expected effective samples per draw (used with ``target_ess``), by default 0.5
+    min_draws : `int`, optional
+        Fewest draws per chain (used with ``target_ess``), by default 200
+    n_cpus : `int`, optional
+        Number of available CPUs, by default None (see :func:`available_cpus`)
+
+    Returns
+    -------
+    plan : `dict`
+        The number of "chains", "cores" (chains at once), "threads" per chain and "draws" per chain, as well as
+        the "n_cpus" that were available
+    """
+    n_cpus = available_cpus() if n_cpus is None else n_cpus
+    if threads is None:
+        limits = thread_limits()
+        set_limits = [limits[var] for var in THREAD_VARIABLES if limits[var] is not None]
+        threads = min(set_limits) if limits["theano_openmp"] and len(set_limits) > 0 else 1
+    threads = max(1, min(threads, n_cpus))
+    slots = max(1, n_cpus // threads)
+
+    if chains is None:
+        chains = max(2, slots)
+    if target_ess is not None:
+        draws = max(min_draws, int(np.ceil(target_ess / (ess_per_draw * chains))))
+    cores = min(chains, slots) if cores is None else cores
+
+    return {"chains": chains, "cores": cores, "threads": threads, "draws": draws, "n_cpus": n_cpus}
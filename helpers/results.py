@@ -0,0 +1,265 @@
+import fcntl
+import io
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+# every system appends its results to one table (one row per planet per optimisation pass) and anything
+# else in the solution (e.g. the model light curves) is saved as separate arrays that are loaded lazily
+RESULTS_FILE = "results.csv"
+ARRAYS_DIR = "arrays"
+
+# parameters with one value per planet and one value per system
+PLANET_PARAMETERS = ["period", "t0", "r", "b", "logP"]
+SYSTEM_PARAMETERS = ["rho_star", "log_rho_star", "mean", "logp"]
+
+COLUMNS = ["system_id", "system_name", "pl_name", "planet_index", "n_planets", "opt_pass", "mission", "exptime",
+           "transit_window", *PLANET_PARAMETERS, *SYSTEM_PARAMETERS, "u1", "u2", "n_logp_grad_evals", "wall_time",
+           "created", "arrays", "data_hash"]
+
+
+def results_path(output_folder):
+    """Path of the results table in an output folder"""
+    return os.path.join(output_folder, RESULTS_FILE)
+
+
+def arrays_path(output_folder, name, opt_pass):
+    """Path of the folder of arrays for one optimisation pass of a system"""
+    return os.path.join(output_folder, ARRAYS_DIR, f"{name.rstrip()}-opt-{opt_pass}")
+
+
+def append_rows(path, rows):
+    """Append rows to a results table, creating it if it doesn't exist yet
+
+    An exclusive lock is held while writing so that many jobs can safely append to the same table at once.
+
+    Parameters
+    ----------
+    path : `str`
+        Path to the table
+    rows : `list`
+        List of dictionaries, with keys from ``COLUMNS`` (missing columns are left empty)
+    """
+    with open(path + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            write_header = not os.path.exists(path) or os.path.getsize(path) == 0
+            buffer = io.StringIO()
+            pd.DataFrame(rows, columns=COLUMNS).to_csv(buffer, index=False, header=write_header)
+            with open(path, "a") as f:
+                f.write(buffer.getvalue())
+                f.flush()
+                os.fsync(f.fileno())
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def save_arrays(path, arrays):
+    """Save arrays as separate .npy files in a folder (each one atomically)
+
+    Parameters
+    ----------
+    path : `str`
+        Folder in which to save the arrays
+    arrays : `dict`
+        Dictionary of arrays
+    """
+    os.makedirs(path, exist_ok=True)
+    for key, array in arrays.items():
+        fd, tmp_path = tempfile.mkstemp(dir=path, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, np.asarray(array))
+        os.replace(tmp_path, os.path.join(path, key + ".npy"))
+
+
+def load_arrays(path, mmap=True):
+    """Load every array in a folder saved by :func:`save_arrays`
+
+    Parameters
+    ----------
+    path : `str`
+        Folder containing the arrays
+    mmap : `bool`, optional
+        Whether to memory-map the arrays (read-only) so that they are only read when used, by default True
+
+    Returns
+    -------
+    arrays : `dict`
+        Dictionary of arrays (empty if the folder doesn't exist)
+    """
+    if not os.path.isdir(path):
+        return {}
+    return {file[:-len(".npy")]: np.load(os.path.join(path, file), mmap_mode="r" if mmap else None)
+            for file in os.listdir(path) if file.endswith(".npy")}
+
+
+def save_solution(output_folder, name, soln, opt_pass, planet_names, system_id=None, **info):
+    """Save the solution of an optimisation pass to the results table (and its other arrays separately)
+
+    Parameters
+    ----------
+    output_folder : `str`
+        Path to folder containing the results
+    name : `str`
+        Name of the system
+    soln : `dict`
+        Optimised parameters
+    opt_pass : `int`
+        Which optimisation pass this is
+    planet_names : `list`
+        Names of the planets
+    system_id : `int`, optional
+        ID of the system, by default None
+    **info
+        Any other columns, e.g. "mission", "exptime", "transit_window", "logp", "n_logp_grad_evals", "wall_time"
+        and "data_hash" (see :func:`data.lc_fingerprint`)
+    """
+    # save the arrays first so that any row in the table always has its arrays
+    table_keys = PLANET_PARAMETERS + SYSTEM_PARAMETERS + ["u"]
+    path = arrays_path(output_folder, name, opt_pass)
+    save_arrays(path, {key: val for key, val in soln.items() if key not in table_keys})
+
+    system = {"system_id": system_id, "system_name": name.rstrip(), "n_planets": len(planet_names),
+              "opt_pass": opt_pass, "u1": soln["u"][0], "u2": soln["u"][1], "created": time.time(),
+              "arrays": os.path.relpath(path, output_folder), **info}
+    system.update({key: float(np.squeeze(soln[key])) for key in SYSTEM_PARAMETERS if key in soln})
+    rows = [{**system, "pl_name": planet_name, "planet_index": i,
+             **{key: soln[key][i] for key in PLANET_PARAMETERS if key in soln}}
+            for i, planet_name in enumerate(planet_names)]
+    append_rows(results_path(output_folder), rows)
+
+
+def load_results(output_folder, latest=True):
+    """Load the results of every system in one go
+
+    Parameters
+    ----------
+    output_folder : `str`
+        Path to folder containing the results
+    latest : `bool`, optional
+        Whether to only keep the most recent result of each planet and pass (if a system was rerun),
+        by default True
+
+    Returns
+    -------
+    results : :class:`~pandas.DataFrame`
+        Table of results, one row per planet per optimisation pass (empty if there are no results yet)
+    """
+    path = results_path(output_folder)
+    if not os.path.exists(path):
+        return pd.DataFrame(columns=COLUMNS)
+
+    # a shared lock means that a row another job is still appending is never read half-written
+    with open(path + ".lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_SH)
+        try:
+            if os.path.getsize(path) == 0:
+                return pd.DataFrame(columns=COLUMNS)
+            results = pd.read_csv(path)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    if latest:
+        newest = results.groupby(["system_name", "opt_pass"])["created"].transform("max")
+        results = results[results["created"] == newest]
+    return results.reset_index(drop=True)
+
+
+def load_solution(output_folder, name, opt_pass, results=None, mmap=True):
+    """Rebuild the solution of an optimisation pass of a system from the results (the inverse of
+    :func:`save_solution`)
+
+    Parameters
+    ----------
+    output_folder : `str`
+        Path to folder containing the results
+    name : `str`
+        Name of the system
+    opt_pass : `int`
+        Which optimisation pass to load
+    results : :class:`~pandas.DataFrame`, optional
+        Results that have already been loaded with :func:`load_results`, by default None (load them)
+    mmap : `bool`, optional
+        Whether to memory-map the arrays, by default True
+
+    Returns
+    -------
+    soln : `dict` or `None`
+        The solution, or None if there isn't one
+    """
+    results = load_results(output_folder) if results is None else results
+    rows = results[(results["system_name"] == name.rstrip()) & (results["opt_pass"] == opt_pass)]
+    if len(rows) == 0:
+        return None
+    rows = rows.sort_values("planet_index")
+    first = rows.iloc[0]
+
+    soln = load_arrays(os.path.join(output_folder, first["arrays"]), mmap=mmap)
+    soln.update({key: rows[key].values.astype(float) for key in PLANET_PARAMETERS})
+    soln.update({key: np.float64(first[key]) for key in SYSTEM_PARAMETERS})
+    soln["u"] = np.array([first["u1"], first["u2"]])
+    return soln
+
+
+def planet_letter(planet_name):
+    """Get the letter of a planet from its name (e.g. "b" for "Kepler-109 b")"""
+    return planet_name.strip().split(" ")[-1].lower()
+
+
+def find_solution(output_folder, name, planet_names, mission, exptime, results=None, mmap=True):
+    """Find the most recent solution of a system fit to the same kind of data, to warm-start a new fit
+
+    Planets are matched by their letter, so the solution is returned in the order of ``planet_names``.
+
+    Parameters
+    ----------
+    output_folder : `str`
+        Path to folder containing the previous results
+    name : `str`
+        Name of the system
+    planet_names : `list`
+        Names of the planets, every one of them must be in the previous solution
+    mission : `str`
+        Mission of the data that was fit
+    exptime : `int`
+        Exposure time of the data that was fit
+    results : :class:`~pandas.DataFrame`, optional
+        Results that have already been loaded with :func:`load_results`, by default None (load them)
+    mmap : `bool`, optional
+        Whether to memory-map the arrays, by default True
+
+    Returns
+    -------
+    soln : `dict` or `None`
+        The solution (as in :func:`load_solution`) along with its "opt_pass", "transit_window" and "data_hash".
+        The other arrays (e.g. "light_curves") are only included if the planets are in the same order as before.
+        None if there is no matching solution.
+    """
+    results = load_results(output_folder) if results is None else results
+    matches = (results["system_name"].str.strip().str.lower() == name.strip().lower())\
+        & (results["mission"] == mission)
+    matches &= results["exptime"].isna() if exptime is None else results["exptime"] == exptime
+    rows = results[matches]
+    if len(rows) == 0:
+        return None
+
+    # the last pass that was saved is the most refined
+    rows = rows[rows["created"] == rows["created"].max()]
+    rows = rows.set_index(rows["pl_name"].map(planet_letter))
+    letters = [planet_letter(planet_name) for planet_name in planet_names]
+    if any(letter not in rows.index for letter in letters):
+        return None
+    first = rows.iloc[0]
+
+    soln = {}
+    if list(rows.sort_values("planet_index").index) == letters:
+        soln = load_arrays(os.path.join(output_folder, first["arrays"]), mmap=mmap)
+    rows = rows.loc[letters]
+    soln.update({key: rows[key].values.astype(float) for key in PLANET_PARAMETERS})
+    soln.update({key: np.float64(first[key]) for key in SYSTEM_PARAMETERS})
+    soln["u"] = np.array([first["u1"], first["u2"]])
+    soln.update({"opt_pass": int(first["opt_pass"]), "transit_window": first["transit_window"],
+                 "data_hash": first["data_hash"]})
+    return soln
@@ -2,13 +2,31 @@ from requests import request
 from collections import defaultdict
 import pandas as pd
 import numpy as np
+import hashlib
+import json
+import os
+import tempfile
+import time
+import zipfile
 
-BASE_URL = "https://exoplanetarchive.ipac.caltech.edu/TAP/sync?query=select+"
+import instrument
+
+# the stand-in server for testing can be used by setting this environment variable
+BASE_URL = os.environ.get("XO_ARCHIVE_URL", "https://exoplanetarchive.ipac.caltech.edu/TAP/sync") + "?query=select+"
+
+# cache of TAP responses, these are kept for 30 days by default
+TAP_CACHE_DIR = os.environ.get("XO_ARCHIVE_CACHE",
+                               os.path.join(os.path.expanduser("~"), ".cache", "radius-valley", "tap"))
+TAP_CACHE_TTL = 30 * 24 * 60 * 60
+
+# when offline, queries are only answered from the cache
+OFFLINE = os.environ.get("XO_ARCHIVE_OFFLINE", "0") == "1"
 
 def get_exoplanet_parameters(search_name, which="default", custom_cond=None,
                              columns=["pl_name", "pl_letter", "pl_orbper", "pl_orbincl", "pl_orbeccen",
                                       "pl_trandep", "pl_tranmid", "pl_trandur", "pl_ratror",
-                                      "pl_imppar", "st_dens", "gaia_id"]):
+                                      "pl_imppar", "st_dens", "gaia_id"],
+                             use_cache=True, refresh=False, offline=None):
     """Get parameters for exoplanets from the Exoplanet Archive using their TAP service
 
     See here for more information: https://exoplanetarchive.ipac.caltech.edu/docs/TAP/usingTAP.html
@@ -34,7 +52,12 @@ def get_exoplanet_parameters(search_name, which="default", custom_cond=None,
         Default units are:
         "pl_orbper" (days), "pl_orbincl" (degrees), "pl_orbeccen" (degrees), "pl_transdep" (%), 
         "pl_tranmid" (Julian date), "pl_trandur" (hours), "pl_ratro" (unitless), "pl_imppar" (unitless), "st_dens" (g/cm^3)
-
+    use_cache : `bool`, optional
+        Whether to use the on-disk cache of archive responses, by default True
+    refresh : `bool`, optional
+        Whether to ignore any cached response and query the archive again, by default False
+    offline : `bool`, optional
+        Whether to only use the cache and never contact the archive, by default None (which uses ``OFFLINE``)
 
     Returns
     -------
@@ -54,25 +77,259 @@ def get_exoplanet_parameters(search_name, which="default", custom_cond=None,
     """
     # decide which table to pull from
     table = "ps" if which in ["default", "all"] else "pscomppars"
-    from_table = f" from {table} where "
 
     # specify conditions on the planet name and whether to get the default parameters
-    name_cond = f"lower(pl_name)+like+'%{search_name.lower()}%'" if search_name is not None else ""
-    default_cond = "default_flag=1" if which == "default" else ""
-    if search_name is not None and which == "default":
-        default_cond = " and " + default_cond
+    conditions = []
+    if search_name is not None:
+        conditions.append(f"lower(pl_name)+like+'%{search_name.lower()}%'")
+    if which == "default":
+        conditions.append("default_flag=1")
 
     # add a custom condition if desired
     if custom_cond is not None:
-        default_cond += f" and {custom_cond}"
+        conditions.append(custom_cond)
+
+    parameters = tap_query(table, columns, conditions, use_cache=use_cache, refresh=refresh, offline=offline)
+
+    if parameters is not None:
+        _add_berger_densities(parameters)
+        return parameters
+
+
+def get_bulk_exoplanet_parameters(system_names, which="composite", batch_size=50,
+                                  columns=["pl_name", "pl_letter", "pl_orbper", "pl_orbincl", "pl_orbeccen",
+                                           "pl_trandep", "pl_tranmid", "pl_trandur", "pl_ratror",
+                                           "pl_imppar", "st_dens", "gaia_id"],
+                                  use_cache=True, refresh=False, offline=None):
+    """Get parameters for the planets in many systems at once, using a few batched queries on the host name
+
+    Parameters
+    ----------
+    system_names : `list`
+        Names of the host stars, e.g. ["Kepler-235", "Kepler-236"], surrounding whitespace is ignored
+    which : `str`, optional
+        Which table of parameters to draw from, see :func:`get_exoplanet_parameters`, by default "composite"
+    batch_size : `int`, optional
+        Maximum number of systems per query (to keep the URLs a sensible length), by default 50
+    columns : `list`, optional
+        Which columns to select from the tables, see :func:`get_exoplanet_parameters`
+    use_cache, refresh, offline : optional
+        Cache settings, see :func:`tap_query`
+
+    Returns
+    -------
+    parameters : `dict`
+        Dictionary with one entry per unique system name, each a list of dictionaries (one for each row)
+        exactly like the output of :func:`get_exoplanet_parameters`. Systems with no matches get an empty list.
+    """
+    table = "ps" if which in ["default", "all"] else "pscomppars"
+    query_columns = columns if "hostname" in columns else columns + ["hostname"]
+
+    # remove duplicates but keep the order so the batches (and so the cache keys) are reproducible
+    unique_names = list(dict.fromkeys(name.strip() for name in system_names))
+
+    rows = []
+    for start in range(0, len(unique_names), batch_size):
+        batch = unique_names[start:start + batch_size]
+        conditions = ["lower(hostname)+in+(" + ",".join(f"'{name.lower()}'" for name in batch) + ")"]
+        if which == "default":
+            conditions.append("default_flag=1")
+        response = tap_query(table, query_columns, conditions,
+                             use_cache=use_cache, refresh=refresh, offline=offline)
+        if response is None:
+            raise ValueError(f"Bulk query failed for systems {batch}")
+        rows.extend(response)
+
+    # look up every density in one go
+    _add_berger_densities(rows)
+
+    parameters = {name: [] for name in unique_names}
+    lower_to_name = {name.lower(): name for name in unique_names}
+    for row in rows:
+        name = lower_to_name.get(row["hostname"].lower())
+        if name is not None:
+            if "hostname" not in columns:
+                row = {key: val for key, val in row.items() if key != "hostname"}
+            parameters[name].append(row)
+    return parameters
+
+
+def _add_berger_densities(parameters):
+    """Add the Berger+2023 densities to a list of rows from the archive (in place) using their Gaia IDs
+
+    Parameters
+    ----------
+    parameters : `list`
+        A list of dictionaries, each corresponding to a row from the table
+    """
+    # convert gaia id strings to ints
+    gaia_ids = [int(p["gaia_id"].split(" ")[-1]) if p["gaia_id"] is not None else np.nan for p in parameters]
+
+    # pass them to helper function and save Berger densities
+    densities = get_berger_density(gaia_ids=gaia_ids)
+    for i in range(len(parameters)):
+        parameters[i]["berger_dens"] = densities[i]
+
+
+def _tap_cache_key(table, columns, conditions):
+    """Work out the cache key of a TAP query, which is independent of the order and spacing of the conditions
+
+    Parameters
+    ----------
+    table : `str`
+        Which table is queried
+    columns : `list`
+        Which columns are selected
+    conditions : `list`
+        Conditions that are combined with "and"
+
+    Returns
+    -------
+    key : `str`
+        Hex digest identifying the query
+    query : `dict`
+        The normalised query
+    """
+    query = {
+        "url": BASE_URL,
+        "table": table.strip().lower(),
+        "columns": [col.strip() for col in columns],
+        "conditions": sorted(" ".join(cond.replace("+", " ").split()) for cond in conditions),
+    }
+    return hashlib.sha1(json.dumps(query, sort_keys=True).encode()).hexdigest(), query
+
+
+def _read_tap_cache(key, ttl=None):
+    """Read a response from the TAP cache
+
+    Parameters
+    ----------
+    key : `str`
+        Cache key of the query
+    ttl : `float`, optional
+        Maximum age of the response in seconds, by default None (which uses ``TAP_CACHE_TTL``)
+
+    Returns
+    -------
+    response : `list` or `None`
+        Cached response or None if it is missing or too old
+    """
+    ttl = TAP_CACHE_TTL if ttl is None else ttl
+    path = os.path.join(TAP_CACHE_DIR, key + ".json")
+    try:
+        with open(path, "r") as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if ttl is not None and time.time() - entry["time"] > ttl:
+        return None
+    return entry["response"]
+
+
+def _write_tap_cache(key, query, response):
+    """Write a response to the TAP cache (atomically, since several jobs may be writing at once)
+
+    Parameters
+    ----------
+    key : `str`
+        Cache key of the query
+    query : `dict`
+        The normalised query
+    response : `list`
+        Response from the archive
+    """
+    os.makedirs(TAP_CACHE_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=TAP_CACHE_DIR, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump({"query": query, "time": time.time(), "response": response}, f)
+    os.replace(tmp_path, os.path.join(TAP_CACHE_DIR, key + ".json"))
+
+
+def clear_tap_cache(table=None, columns=None, conditions=None, older_than=None):
+    """Invalidate cached TAP responses
+
+    Parameters
+    ----------
+    table, columns, conditions : optional
+        Specify all three to remove only that particular query, otherwise every response is considered
+    older_than : `float`, optional
+        Only remove responses that are older than this many seconds, by default None (remove regardless)
+
+    Returns
+    -------
+    n_removed : `int`
+        How many responses were removed
+    """
+    if not os.path.isdir(TAP_CACHE_DIR):
+        return 0
+
+    if table is not None and columns is not None and conditions is not None:
+        paths = [os.path.join(TAP_CACHE_DIR, _tap_cache_key(table, columns, conditions)[0] + ".json")]
+    else:
+        paths = [os.path.join(TAP_CACHE_DIR, f) for f in os.listdir(TAP_CACHE_DIR) if f.endswith(".json")]
+
+    n_removed = 0
+    for path in paths:
+        try:
+            if older_than is None or time.time() - os.path.getmtime(path) > older_than:
+                os.remove(path)
+                n_removed += 1
+        except FileNotFoundError:
+            pass
+    return n_removed
 
-    # force the format to be JSON
-    fmt = "&format=JSON"
 
-    # combine into URL and perform the request
-    url = BASE_URL + ','.join(columns) + from_table + name_cond + default_cond + fmt
+def tap_query(table, columns, conditions, use_cache=True, refresh=False, offline=None, ttl=None):
+    """Perform a query with the Exoplanet Archive TAP service, using the on-disk cache where possible
 
-    r = request(method="GET", url=url)
+    Parameters
+    ----------
+    table : `str`
+        Which table to query, e.g. "ps" or "pscomppars"
+    columns : `list`
+        Which columns to select
+    conditions : `list`
+        Conditions that rows must satisfy, these are combined with "and"
+    use_cache : `bool`, optional
+        Whether to read from and write to the cache, by default True
+    refresh : `bool`, optional
+        Whether to skip reading the cache (the new response is still written), by default False
+    offline : `bool`, optional
+        Whether to only use the cache, by default None (which uses ``OFFLINE``)
+    ttl : `float`, optional
+        Maximum age of a cached response in seconds, by default None (which uses ``TAP_CACHE_TTL``)
+
+    Returns
+    -------
+    response : `list` or `None`
+        A list of dictionaries, one per row, or None if the request failed
+
+    Raises
+    ------
+    LookupError
+        If working offline and the query is not in the cache
+    """
+    offline = OFFLINE if offline is None else offline
+    key, query = _tap_cache_key(table, columns, conditions)
+
+    if use_cache and not refresh:
+        with instrument.stage("tap_cache_load") as record:
+            response = _read_tap_cache(key, ttl=ttl)
+            record["hit"] = response is not None
+        if response is not None:
+            return response
+
+    if offline:
+        raise LookupError(f"Working offline and TAP query is not cached: {query}")
+
+    # combine into URL and perform the request (forcing the format to be JSON)
+    url = BASE_URL + ','.join(columns) + f" from {table}"
+    if len(conditions) > 0:
+        url += " where " + " and ".join(conditions)
+    url += "&format=JSON"
+
+    with instrument.stage("tap_query", table=table):
+        r = request(method="GET", url=url)
 
     # print out an error if it failed, otherwise return the JSON
     if r.status_code != 200:
@@ -81,18 +338,169 @@ def get_exoplanet_parameters(search_name, which="default", custom_cond=None,
         print(r.text.rstrip())
         print("=======================================================")
         print(f"URL used: {url}")
-        
-    else:
-        parameters = r.json()
+        return None
 
-        # convert gaia id strings to ints
-        gaia_ids = [int(p["gaia_id"].split(" ")[-1]) if p["gaia_id"] is not None else np.nan for p in parameters] 
+    response = r.json()
+    if use_cache:
+        _write_tap_cache(key, query, response)
+    return response
 
-        # pass them to helper function and save Berger densities
-        densities = get_berger_density(gaia_ids=gaia_ids) 
-        for i in range(len(parameters)):
-            parameters[i]["berger_dens"] = densities[i]
-        return parameters
+
+BERGER_COLUMNS = ["iso_teff", "iso_logg", "iso_feh", "iso_mass", "iso_rad", "iso_rho", "iso_lum", "iso_age",
+                  "iso_dis"]
+BERGER_DIR = os.path.dirname(os.path.abspath(__file__))
+BERGER_INDEX = os.path.join(BERGER_DIR, "GKTHCatalog_index.npz")
+
+# process-wide copy of the catalog index, built the first time that it is needed
+_berger_catalog = None
+
+
+def _build_berger_catalog():
+    """Join the two Berger+2023 tables on star name and sort the result by Gaia DR3 ID
+
+    Returns
+    -------
+    catalog : `dict`
+        Dictionary containing a sorted "dr3_source_id" array, a "n_star_ids" array (the number of stellar IDs
+        associated with each Gaia ID) and one array for every column in ``BERGER_COLUMNS`` and their errors
+    """
+    gaia_df = pd.read_csv(os.path.join(BERGER_DIR, "GKTHCatalog_Table2.csv"),
+                          usecols=["id_starname", "dr3_source_id"])
+    stellar_df = pd.read_csv(os.path.join(BERGER_DIR, "GKTHCatalog_Table4.csv"))
+
+    # some Gaia IDs match more than one star, in which case we take the first one (as in the table)
+    n_star_ids = gaia_df.groupby("dr3_source_id")["id_starname"].transform("size")
+    gaia_df = gaia_df.assign(n_star_ids=n_star_ids).drop_duplicates("dr3_source_id", keep="first")
+
+    # a left join keeps Gaia IDs that have no stellar parameters (they just get NaNs)
+    joined = gaia_df.merge(stellar_df, on="id_starname", how="left").sort_values("dr3_source_id")
+
+    catalog = {"dr3_source_id": joined["dr3_source_id"].values.astype(np.int64),
+               "n_star_ids": joined["n_star_ids"].values.astype(np.int64)}
+    for col in BERGER_COLUMNS:
+        for suffix in ["", "_err1", "_err2"]:
+            if col + suffix in joined:
+                # some values (e.g. ages) are flagged with a leading "*", strip it before converting
+                values = joined[col + suffix]
+                if not pd.api.types.is_numeric_dtype(values):
+                    values = pd.to_numeric(values.astype(str).str.lstrip("*"), errors="coerce")
+                catalog[col + suffix] = values.values.astype(float)
+    return catalog
+
+
+def load_berger_catalog(rebuild=False):
+    """Load the (cached) index of the Berger+2023 catalog
+
+    The joined catalog is built once from the CSV tables and then stored in a binary sidecar file next to
+    them, which is rebuilt automatically whenever either of the CSV files is newer than it.
+
+    Parameters
+    ----------
+    rebuild : `bool`, optional
+        Whether to force the index to be rebuilt from the CSV files, by default False
+
+    Returns
+    -------
+    catalog : `dict`
+        Dictionary of arrays, see :func:`_build_berger_catalog`
+    """
+    global _berger_catalog
+    if _berger_catalog is not None and not rebuild:
+        return _berger_catalog
+
+    csv_mtime = max(os.path.getmtime(os.path.join(BERGER_DIR, f"GKTHCatalog_Table{i}.csv")) for i in [2, 4])
+    if not rebuild and os.path.exists(BERGER_INDEX) and os.path.getmtime(BERGER_INDEX) >= csv_mtime:
+        # a broken index (e.g. from an old crash) is just rebuilt
+        try:
+            with np.load(BERGER_INDEX) as f:
+                _berger_catalog = {key: f[key] for key in f.files}
+            return _berger_catalog
+        except (OSError, ValueError, zipfile.BadZipFile):
+            pass
+
+    _berger_catalog = _build_berger_catalog()
+
+    # try to save the index for next time but don't worry if the directory isn't writeable
+    # (it is written to a temporary file first so other processes never see a half-written index)
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=BERGER_DIR, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, **_berger_catalog)
+            os.replace(tmp_path, BERGER_INDEX)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+    except OSError:
+        pass
+    return _berger_catalog
+
+
+def _gaia_ids_to_array(gaia_ids):
+    """Convert a collection of Gaia IDs (which may contain NaNs or Nones) to an integer array, using -1 for missing IDs
+
+    Parameters
+    ----------
+    gaia_ids : `list` or `np.ndarray`
+        IDs for Gaia in DR3
+
+    Returns
+    -------
+    gaia_ids : `np.ndarray`
+        Array of integer IDs
+    """
+    if isinstance(gaia_ids, np.ndarray) and np.issubdtype(gaia_ids.dtype, np.integer):
+        return gaia_ids.astype(np.int64)
+
+    # don't go via a float array here, 19 digit IDs would lose precision
+    return np.array([-1 if gid is None or (isinstance(gid, float) and np.isnan(gid)) else int(gid)
+                     for gid in gaia_ids], dtype=np.int64)
+
+
+def get_berger_parameters(gaia_ids, columns=None, errors=True, fill_value=np.nan):
+    """Get stellar parameters estimated by Berger+2023 for a collection of Gaia IDs
+
+    Parameters
+    ----------
+    gaia_ids : `list` or `np.ndarray`
+        IDs for Gaia in DR3, any that are NaN or None are treated as missing
+    columns : `list`, optional
+        Which columns to get, any of ``BERGER_COLUMNS``, by default all of them
+    errors : `bool`, optional
+        Whether to also return the upper and lower errors (as "<col>_err1" and "<col>_err2"), by default True
+    fill_value : `float`, optional
+        Value to use for IDs that aren't in the catalog, by default np.nan
+
+    Returns
+    -------
+    parameters : `dict`
+        Dictionary of arrays, one for each column, with one value per Gaia ID
+    """
+    with instrument.stage("berger_load"):
+        catalog = load_berger_catalog()
+    columns = BERGER_COLUMNS if columns is None else columns
+    ids = _gaia_ids_to_array(gaia_ids)
+
+    # binary search for each ID in the sorted catalog
+    sorted_ids = catalog["dr3_source_id"]
+    inds = np.searchsorted(sorted_ids, ids).clip(max=len(sorted_ids) - 1)
+    found = (sorted_ids[inds] == ids) & (ids >= 0)
+
+    if np.any(catalog["n_star_ids"][inds[found]] > 1):
+        print('error! gaia id found to have more than one stellar id ')
+
+    parameters = {}
+    for col in columns:
+        for key in ([col, col + "_err1", col + "_err2"] if errors else [col]):
+            if key not in catalog:
+                continue
+            values = np.repeat(fill_value, len(ids)).astype(float)
+            values[found] = catalog[key][inds[found]]
+
+            # stars that are in the Gaia table but not the stellar one will have NaNs
+            values[np.isnan(values)] = fill_value
+            parameters[key] = values
+    return parameters
 
 
 def get_berger_density(gaia_ids):
@@ -105,35 +513,11 @@ def get_berger_density(gaia_ids):
 
     Returns
     -------
-    densities : `list`
-        Densities in g/cm^3
+    densities : `np.ndarray`
+        Densities in g/cm^3 (-1 for any ID that isn't in the catalog)
     """
-    # yes, this is such a hack please don't judge me
-    base = __file__.replace("/xo_archive.py", "/")
-    stellar_df = pd.read_csv(base + "GKTHCatalog_Table4.csv")
-    gaia_df = pd.read_csv(base + "GKTHCatalog_Table2.csv")
-    
-    densities = np.repeat(-1, len(gaia_ids)).astype(float) 
-        
-    for i in range(len(gaia_ids)): 
-        if np.isnan(gaia_ids[i]) == False: 
-            in_gaia_table = gaia_df["dr3_source_id"] == gaia_ids[i]
-            star_id = gaia_df[in_gaia_table]["id_starname"].values.tolist()
-                
-            if star_id != []:
-                in_stellar_table = stellar_df["id_starname"] == star_id[0]
-                density = stellar_df[in_stellar_table]["iso_rho"].values.tolist()
-                if len(density)>1:
-                    print('error! gaia id found to have more than one berger density') 
-                densities[i] = density[0]  
-            #else:
-            #    print('not in table!') 
-               
-            if len(star_id)>1:
-                print('error! gaia id found to have more than one stellar id ') 
-        #else:
-        #    print('nan!') 
-    return densities
+    return get_berger_parameters(gaia_ids, columns=["iso_rho"], errors=False, fill_value=-1.0)["iso_rho"]
+
 
 def transpose_parameters(parameters):
     """Transform a list of dictionaries of parameters into a dictionary of lists
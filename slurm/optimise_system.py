@@ -1,19 +1,322 @@
 import argparse
 
-import exoplanet as xo
-import lightkurve as lk
-import astropy.units as u
-import matplotlib.pyplot as plt
 import numpy as np
 
+import json
 import os
 import sys
+import tempfile
+import time
 sys.path.append('../helpers')
+import compact_lc
+import compile_cache
 import data
+import diagnostics
 import xo_archive
-import fit
+import instrument
+import manifest
+import results
+
+# the fitting code (exoplanet, pymc3 and Theano) is only imported when a model is built, lightkurve only if the
+# light curve isn't cached and matplotlib only when plotting, so a task starts (and fails on bad input) quickly
+
+N_PASSES = 3
+
+
+def metrics_path(output_folder, name):
+    """Path of the file of timing and memory metrics of a system"""
+    return os.path.join(output_folder, f"{name.rstrip()}-metrics.json")
+
+
+def status_path(output_folder, name):
+    """Path of the file that tracks which stages of a system are complete"""
+    return os.path.join(output_folder, f"{name.rstrip()}-status.json")
+
+
+def load_status(output_folder, name):
+    """Load the completed stages of a system
+
+    Parameters
+    ----------
+    output_folder : `str`
+        Path to folder containing the output
+    name : `str`
+        Name of the system
+
+    Returns
+    -------
+    status : `dict`
+        Dictionary of the completed stages ("params", "data", "opt-1", "opt-2", "opt-3", "complete")
+        and the names of the planets, empty if nothing has been run yet
+    """
+    try:
+        with open(status_path(output_folder, name), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_status(output_folder, name, status):
+    """Save the completed stages of a system (atomically, so a crash can't leave a broken file)"""
+    fd, tmp_path = tempfile.mkstemp(dir=output_folder, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(status, f)
+    os.replace(tmp_path, status_path(output_folder, name))
+
+
+def load_solution(output_folder, name, opt_pass, loaded_results=None):
+    """Load a saved optimisation solution from the results store, checking that it is valid
+
+    Parameters
+    ----------
+    output_folder : `str`
+        Path to folder containing the output
+    name : `str`
+        Name of the system
+    opt_pass : `int`
+        Which optimisation pass to load
+    loaded_results : :class:`~pandas.DataFrame`, optional
+        Results that have already been loaded with :func:`results.load_results`, by default None (load them)
+
+    Returns
+    -------
+    soln : `dict` or `None`
+        The solution, or None if it doesn't exist or is incomplete
+    """
+    try:
+        soln = results.load_solution(output_folder, name, opt_pass, results=loaded_results)
+    except (OSError, ValueError, KeyError):
+        return None
+    required = ["period", "t0", "r", "b", "rho_star", "u", "mean", "light_curves", "lc_keep"]
+    if soln is None or any(key not in soln for key in required):
+        return None
+    if not all(np.all(np.isfinite(soln[key])) for key in required[:-2]):
+        return None
+    return soln
+
+
+def system_complete(output_folder, name, loaded_results=None):
+    """Check whether every stage of a system is complete and its outputs are valid
+
+    Parameters
+    ----------
+    output_folder : `str`
+        Path to folder containing the output
+    name : `str`
+        Name of the system
+    loaded_results : :class:`~pandas.DataFrame`, optional
+        Results that have already been loaded with :func:`results.load_results`, by default None (load them)
+
+    Returns
+    -------
+    complete : `bool`
+        Whether the system is complete
+    """
+    status = load_status(output_folder, name)
+    if not status.get("complete", False) or not status.get(f"opt-{N_PASSES}", False):
+        return False
+    return load_solution(output_folder, name, N_PASSES, loaded_results=loaded_results) is not None
+
+
+def next_guesses(soln):
+    """Turn the solution of one optimisation pass into the initial guesses for the next"""
+    from astropy.time import Time
+    compact_lc.register_time_formats()
+
+    updated_params = {}
+    updated_params["pl_orbper"] = soln["period"]
+    updated_params["pl_tranmid"] = Time(soln["t0"], format="bkjd").jd
+    updated_params["pl_ratror"] = soln["r"]
+    updated_params["pl_imppar"] = soln["b"]
+    updated_params["berger_dens"] = [soln["rho_star"]]
+    return updated_params
+
+
+def warm_start_valid(warm, data_hash, transit_window):
+    """Check whether a previous solution (see :func:`results.find_solution`) can be reused without re-optimising
+
+    It must be a final optimisation pass, fit to exactly the same data (as given by :func:`data.lc_fingerprint`)
+    with the same transit window and have its model light curves.
+    """
+    same_window = (transit_window is None and np.isnan(warm["transit_window"]))\
+        or (transit_window is not None and warm["transit_window"] == transit_window)
+    return warm["opt_pass"] == N_PASSES and warm["data_hash"] == data_hash and same_window\
+        and "light_curves" in warm and np.isfinite(warm["logp"])
+
+
+def run_system(name, system_id=None, output_folder=".", mission="Kepler", exp_time=1800, n_workers=1,
+               transit_window=None, manifest_file=None, offline=None, resume=True, plot=False,
+               profile_stages=None, warm_start=None):
+    """Run every stage of the fit of a single system, resuming from any stages that are already complete
+
+    The stages are collecting the parameters ("params"), getting the light curve ("data") and each optimisation
+    pass ("opt-1", "opt-2", "opt-3"). Each optimisation pass is saved as soon as it finishes, so if the run is
+    interrupted then the next one starts from the last valid pass. The time and memory used by each stage are
+    saved to a metrics file alongside the other output.
+
+    Plotting is not part of the fit: the plots are made afterwards from the stored results and the light curve
+    cache (see ``plot_systems.py`` and :func:`diagnostics.render_system`), so a batch of fits never waits on it.
+
+    Parameters
+    ----------
+    name : `str`
+        Name of the system
+    system_id : `int`, optional
+        ID of the system (only needed when reading from a manifest), by default None
+    output_folder : `str`, optional
+        Path to folder in which to place output, by default "."
+    mission : `str`, optional
+        Which mission to get observations from, by default "Kepler"
+    exp_time : `int`, optional
+        Exposure time data to select, by default 1800. If None then every cadence is used and the model uses
+        the exposure time of each cadence (see :func:`data.estimate_exptimes`).
+    n_workers : `int`, optional
+        Number of processes to use for extracting the light curves, by default 1
+    transit_window : `float`, optional
+        Only fit data within this many transit durations of each transit, by default None (fit all data)
+    manifest_file : `str`, optional
+        Manifest of prefetched parameters to use instead of the Exoplanet Archive, by default None
+    offline : `bool`, optional
+        Only use cached Exoplanet Archive responses and the local MAST mirror, by default None
+    resume : `bool`, optional
+        Whether to reuse the outputs of stages that are already complete, by default True
+    plot : `bool`, optional
+        Whether to also plot the fit once it is complete (see :func:`diagnostics.plot_system`), by default False
+    profile_stages : `list`, optional
+        Names of stages to profile with cProfile, see :class:`instrument.Metrics`, by default None
+    warm_start : `str`, optional
+        Output folder of previous fits. The most recent solution there for the same system, mission and exposure
+        time is used as the starting point of the optimisation, or reused without optimising if it was fit to
+        exactly the same data. By default None (start from the archive parameters).
+
+    Returns
+    -------
+    soln : `dict`
+        The solution of the final optimisation pass
+    """
+    status = load_status(output_folder, name) if resume else {}
+    if resume and system_complete(output_folder, name):
+        print(f"All stages already complete for {name}, skipping")
+        return load_solution(output_folder, name, N_PASSES)
+
+    # record the time and memory used by each stage
+    metrics = instrument.Metrics(name, profile_stages=profile_stages, profile_dir=output_folder)
+    try:
+        with metrics:
+            return _run_stages(name, status, system_id=system_id, output_folder=output_folder, mission=mission,
+                               exp_time=exp_time, n_workers=n_workers, transit_window=transit_window,
+                               manifest_file=manifest_file, offline=offline, resume=resume, plot=plot,
+                               warm_start=warm_start)
+    finally:
+        metrics.save(metrics_path(output_folder, name))
+
+
+def _run_stages(name, status, system_id, output_folder, mission, exp_time, n_workers, transit_window,
+                manifest_file, offline, resume, plot, warm_start):
+    """Run the stages of :func:`run_system` (see there for the parameters)"""
+    # Collect the planetary parameters with xo_archive (or from the prefetched manifest)
+    # composite values are collected (keep track of where for stellar)
+    with instrument.stage("params"):
+        if manifest_file is not None:
+            planet_parameters = manifest.read_manifest(manifest_file, system_id)
+        else:
+            planet_parameters = xo_archive.get_exoplanet_parameters(name, which="composite", offline=offline)
+
+    # Create a list of all the parameters in the system
+    param_lists = xo_archive.transpose_parameters(planet_parameters)
+    status.update({"params": True, "planet_names": param_lists["pl_name"]})
+    save_status(output_folder, name, status)
+
+    print("Found initial parameters for the systems:")
+    print(planet_parameters)
+
+    with instrument.stage("data") as record:
+        # the light curve cache means this is quick if it has been done before
+        flat_lc = data.get_flattened_lc(name, mission=mission, exptime=exp_time, n_workers=n_workers,
+                                        offline=offline, compact=True)
+
+        # Remove Outliers
+        # (the mask of the cadences that are kept is saved with the results so the plots can be made later)
+        lc, lc_keep = data.remove_outliers(flat_lc, param_lists["pl_orbper"], param_lists["pl_tranmid"],
+                                           param_lists["pl_trandur"], transit_sigma_upper=5, return_mask=True)
+        record["n_cadences"] = len(lc)
+    status["data"] = True
+    save_status(output_folder, name, status)
+
+    print("Lightcurve retrieved, flattened and outliers removed, commencing fit...")
+
+    # find the last optimisation pass that is already complete
+    soln = None
+    first_pass = 1
+    if resume:
+        for opt_pass in range(N_PASSES, 0, -1):
+            previous = load_solution(output_folder, name, opt_pass) if status.get(f"opt-{opt_pass}", False) else None
+            if previous is not None:
+                print(f"Optimisation pass {opt_pass} already complete, loading it")
+                soln, first_pass = previous, opt_pass + 1
+                break
+
+    # a previous fit can be reused outright if it was to exactly the same data, or otherwise used as a warm start
+    data_hash = data.lc_fingerprint(lc)
+    warm = None
+    if warm_start is not None and first_pass <= N_PASSES:
+        warm = results.find_solution(warm_start, name, param_lists["pl_name"], mission, exp_time)
+    if warm is not None and warm_start_valid(warm, data_hash, transit_window):
+        print(f"Found a valid optimised solution in {warm_start}, reusing it")
+        soln = {key: val for key, val in warm.items() if key not in ["opt_pass", "transit_window", "data_hash"]}
+        soln["lc_keep"] = lc_keep
+        results.save_solution(output_folder, name, soln, N_PASSES, param_lists["pl_name"], system_id=system_id,
+                              mission=mission, exptime=exp_time, transit_window=transit_window, logp=soln["logp"],
+                              wall_time=0.0, data_hash=data_hash)
+        status.update({f"opt-{opt_pass}": True for opt_pass in range(1, N_PASSES + 1)})
+        save_status(output_folder, name, status)
+        first_pass = N_PASSES + 1
+    elif warm is not None:
+        print(f"Warm-starting from the solution in {warm_start}")
+
+    # build (and compile) the model once, then reuse it for each pass of the optimisation
+    # (but only if there is a pass that still needs to be run)
+    model = None
+    for opt_pass in range(first_pass, N_PASSES + 1):
+        start_time = time.perf_counter()
+        with instrument.stage(f"opt-{opt_pass}"):
+            if model is None:
+                with instrument.stage("import") as record:
+                    import fit
+                    record["compile_dir"] = compile_cache.configure()
+
+                # mixed cadences need the exposure time of each cadence
+                texp = exp_time / 86400 if exp_time is not None\
+                    else data.estimate_exptimes(compact_lc.lc_arrays(lc)[0], mission=mission)
+                model = fit.TransitModel(lc, param_lists, texp=texp, transit_window=transit_window)
+
+            # the first pass uses the archive parameters (or a previous fit) and the rest re-optimise from the
+            # previous solution
+            if soln is None and warm is not None:
+                soln = model.optimize(next_guesses(warm), u_init=warm["u"], start=warm)
+            elif soln is None:
+                soln = model.optimize(param_lists)
+            else:
+                soln = model.optimize(next_guesses(soln), u_init=soln["u"])
+            soln["lc_keep"] = lc_keep
+
+        results.save_solution(output_folder, name, soln, opt_pass, param_lists["pl_name"], system_id=system_id,
+                              mission=mission, exptime=exp_time, transit_window=transit_window, logp=model.logp,
+                              n_logp_grad_evals=model.nfev, wall_time=time.perf_counter() - start_time,
+                              data_hash=data_hash)
+        status[f"opt-{opt_pass}"] = True
+        save_status(output_folder, name, status)
+
+    print("Fitting complete!")
+    status["complete"] = True
+    save_status(output_folder, name, status)
+
+    if plot:
+        with instrument.stage("plots"):
+            t, y, _ = compact_lc.lc_arrays(lc)
+            diagnostics.plot_system(t, y, soln, param_lists["pl_name"], output_folder, name)
+    return soln
 
-from astropy.time import Time
 
 def main():
     parser = argparse.ArgumentParser(description='Optimise the parameters of an exoplanet system')
@@ -26,7 +329,25 @@ def main():
     parser.add_argument('-m', '--mission', default="Kepler", type=str,
                         help='Which mission to get observations from')
     parser.add_argument('-e', '--exp_time', default=1800, type=int,
-                        help='Exposure time data to select')
+                        help='Exposure time data to select (0 for every cadence)')
+    parser.add_argument('--offline', action='store_true',
+                        help='Only use cached Exoplanet Archive responses and the local MAST mirror')
+    parser.add_argument('-n', '--n_workers', default=1, type=int,
+                        help='Number of processes to use for extracting the light curves')
+    parser.add_argument('-w', '--transit_window', default=None, type=float,
+                        help='Only fit data within this many transit durations of each transit (bin the rest)')
+    parser.add_argument('--manifest', default=None, type=str,
+                        help='Manifest of prefetched parameters to use instead of the Exoplanet Archive')
+    parser.add_argument('--no_resume', action='store_true',
+                        help='Rerun every stage, even if there is already valid output')
+    parser.add_argument('--warm_start', default=None, type=str,
+                        help='Output folder of previous fits to warm-start from (or reuse if the data are the same)')
+    parser.add_argument('--prewarm', action='store_true',
+                        help='Compile template models into the node-local Theano cache first (once per job)')
+    parser.add_argument('--plot', action='store_true',
+                        help='Plot the fit once it is complete (otherwise use plot_systems.py afterwards)')
+    parser.add_argument('--profile', default=None, type=str,
+                        help='Comma-separated stages to profile with cProfile, e.g. "pld,optimize" (or "all")')
     args = parser.parse_args()
 
     matched_name = None
@@ -39,92 +360,19 @@ def main():
 
     if matched_name is None:
         raise ValueError("Unknown system ID")
-    
-    print(f"Running optimisation for system: {matched_name}")
 
-    # Collect the planetary parameters with xo_archive
-    # composite values are collected (keep track of where for stellar)
-    planet_parameters = xo_archive.get_exoplanet_parameters(matched_name, which="composite")
-    n_planets = len(planet_parameters)
-
-    # Create a list of all the parameters in the system
-    param_lists = xo_archive.transpose_parameters(planet_parameters)
-
-    print("Found initial parameters for the systems:")
-    print(planet_parameters)
-
-    flat_lc = data.get_flattened_lc(matched_name, mission=args.mission, exptime=args.exp_time)
-
-    # Remove Outliers
-    lc = data.remove_outliers(flat_lc, param_lists["pl_orbper"], param_lists["pl_tranmid"],
-                              param_lists["pl_trandur"], transit_sigma_upper=5)
-
-    # Folded light curves are created here
-    # for i in range(len(planet_parameters)):
-    #     lc.fold(period=planet_parameters[i]["pl_orbper"],
-    #             epoch_time=Time(planet_parameters[i]["pl_tranmid"] * u.day, format="jd").bkjd).scatter(label=planet_parameters[i]["pl_name"])
-
-    print("Lightcurve retrieved, flattened and outliers removed, commencing fit...")
-
-    # create list of new parameters based on given parameters
-    map_soln, model = fit.optimise_model(lc, param_lists)
-
-    np.save(os.path.join(args.output_folder, f"{matched_name.rstrip()}-opt-params-1.py"), map_soln)
-
-    # Re-optimizing the parameters: "new_soln_1"
-    updated_params = {}
-    updated_params["pl_orbper"] = map_soln["period"]
-    updated_params["pl_tranmid"] = Time(map_soln["t0"], format="bkjd").jd
-    updated_params["pl_ratror"] = map_soln["r"]
-    updated_params["pl_imppar"] = map_soln["b"]
-    updated_params["berger_dens"] = [map_soln["rho_star"]]
-    new_soln_1, model = fit.optimise_model(lc, updated_params, u_init=map_soln["u"])
-
-    np.save(os.path.join(args.output_folder, f"{matched_name.rstrip()}-opt-params-2.py"), new_soln_1)
-    
-    # Re-optimizing the parameters: "new_soln_2"
-    updated_params = {}
-    updated_params["pl_orbper"] = new_soln_1["period"]
-    updated_params["pl_tranmid"] = Time(new_soln_1["t0"], format="bkjd").jd
-    updated_params["pl_ratror"] = new_soln_1["r"]
-    updated_params["pl_imppar"] = new_soln_1["b"]
-    updated_params["berger_dens"] = [new_soln_1["rho_star"]]
-    new_soln_2, model = fit.optimise_model(lc, updated_params, u_init=new_soln_1["u"])
-
-    np.save(os.path.join(args.output_folder, f"{matched_name.rstrip()}-opt-params-3.py"), new_soln_2)
+    print(f"Running optimisation for system: {matched_name}")
 
-    print("Fitting complete!")
+    # later tasks of the same job on this node find the cache already warm and skip this
+    if args.prewarm:
+        compile_cache.prewarm(per_cadence_texp=args.exp_time <= 0)
 
-    # Optimized LC
-    t = lc["time"].value
-    y = lc["flux"].value
-    for i in range(n_planets):
-        plt.figure()
-        p = new_soln_2["period"][i]
-        t0 = new_soln_2["t0"][i]
-
-        # Plot the folded data
-        x_fold = (t - t0 + 0.5 * p) % p - 0.5 * p
-        plt.scatter(
-            x_fold, y, label="data", zorder=-1000, s=0.1, color="black"
-        )
-        # Plot the folded model within 0.3 days of the transit
-        inds = np.argsort(x_fold)
-        inds = inds[np.abs(x_fold)[inds] < 0.3]
-        pred = new_soln_2["light_curves"][inds, i] + new_soln_2["mean"]
-        plt.plot(x_fold[inds], pred, color="firebrick", label="optimised model")
-        plt.ylabel("relative flux")
-        plt.xlabel("time [days]")
-        _ = plt.xlim(t.min(), t.max())
-        plt.legend(fontsize=10, loc=4)
-        plt.xlim(-0.5 * p, 0.5 * p)
-        plt.xlabel("Time since transit [days]")
-        plt.ylabel("Relative flux")
-        plt.title(param_lists["pl_name"][i])
-        plt.xlim(-0.3, 0.3)
-        plt.savefig(os.path.join(args.output_folder, f"{matched_name.rstrip()}-opt-fit-{param_lists['pl_name'][i]}.pdf"),
-                    format="pdf", bbox_inches="tight")
-        plt.show()
+    run_system(matched_name, system_id=args.system_id, output_folder=args.output_folder, mission=args.mission,
+               exp_time=args.exp_time if args.exp_time > 0 else None, n_workers=args.n_workers,
+               transit_window=args.transit_window,
+               manifest_file=args.manifest, offline=args.offline or None, resume=not args.no_resume,
+               profile_stages=args.profile.split(",") if args.profile is not None else None,
+               warm_start=args.warm_start, plot=args.plot)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
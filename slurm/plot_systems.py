@@ -0,0 +1,86 @@
+import argparse
+import os
+import sys
+import time
+import traceback
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
+
+sys.path.append('../helpers')
+import results
+import resources
+
+
+def _plot_one(output_folder, name, rows, plot_kwargs):
+    """Plot a single system in a worker, catching any errors so that the rest of the batch carries on
+
+    Returns
+    -------
+    name : `str`
+        Name of the system
+    error : `str` or `None`
+        Traceback of the error, or None if the plots were made
+    runtime : `float`
+        How long the plots took in seconds
+    """
+    import diagnostics
+
+    start = time.time()
+    try:
+        diagnostics.render_system(output_folder, name, loaded_results=rows, **plot_kwargs)
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+    return name, error, time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Plot the optimised fits of every system in an output folder')
+    parser.add_argument('-o', '--output_folder', default=".", type=str,
+                        help='Path to folder containing the results (the plots are placed here too)')
+    parser.add_argument('-f', '--file_name', default=None, type=str,
+                        help='Only plot the systems in this file of systems and IDs (default: every system)')
+    parser.add_argument('-j', '--n_workers', default=None, type=int,
+                        help='Number of systems to plot at once (default: number of CPUs)')
+    parser.add_argument('--format', default="png", type=str,
+                        help='File format of the plots, e.g. "png" or "pdf"')
+    parser.add_argument('--opt_pass', default=None, type=int,
+                        help='Which optimisation pass to plot (default: the last one of each system)')
+    args = parser.parse_args()
+
+    # the results table is read once and each worker only gets the rows of its own system
+    all_results = results.load_results(args.output_folder)
+    names = list(all_results["system_name"].unique())
+    if args.file_name is not None:
+        import manifest
+        wanted = {sys_name.strip() for sys_name in manifest.read_systems_file(args.file_name).values()}
+        names = [name for name in names if name in wanted]
+    print(f"Plotting {len(names)} systems from {args.output_folder}")
+
+    # plotting is single-threaded so use one worker per CPU (and never open any windows)
+    n_workers = args.n_workers if args.n_workers is not None else resources.available_cpus()
+    resources.set_thread_limits(1)
+    os.environ["MPLBACKEND"] = "Agg"
+
+    plot_kwargs = {"fmt": args.format, "opt_pass": args.opt_pass}
+    failed = []
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=get_context("spawn")) as executor:
+        futures = [executor.submit(_plot_one, args.output_folder, name,
+                                   all_results[all_results["system_name"] == name], plot_kwargs) for name in names]
+        for future in as_completed(futures):
+            name, error, runtime = future.result()
+            if error is None:
+                print(f"Plotted {name} in {runtime:.1f}s")
+            else:
+                failed.append(name)
+                print(f"Plotting {name} failed after {runtime:.1f}s:")
+                print(error)
+
+    print(f"Plotting complete: {len(names) - len(failed)} succeeded, {len(failed)} failed")
+    if len(failed) > 0:
+        print(f"Failed systems: {', '.join(sorted(failed))}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,29 @@
+import argparse
+
+import sys
+sys.path.append('../helpers')
+import manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Prefetch the parameters of every system in a file into a manifest')
+    parser.add_argument('-f', '--file_name', default="systems.txt", type=str,
+                        help='File containing list of systems and IDs')
+    parser.add_argument('-o', '--output_file', default="manifest.csv", type=str,
+                        help='Path at which to save the manifest')
+    parser.add_argument('-w', '--which', default="composite", type=str,
+                        help='Which table of parameters to use ("default", "all" or "composite")')
+    parser.add_argument('-b', '--batch_size', default=50, type=int,
+                        help='Maximum number of systems per query')
+    parser.add_argument('--refresh', action='store_true',
+                        help='Ignore any cached Exoplanet Archive responses')
+    args = parser.parse_args()
+
+    params = manifest.write_manifest(args.file_name, args.output_file, which=args.which,
+                                     batch_size=args.batch_size, refresh=args.refresh)
+    print(f"Saved parameters for {params['system_id'].nunique()} systems ({len(params)} planets) "
+          f"to {args.output_file}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+import argparse
+import os
+import sys
+import time
+import traceback
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
+
+sys.path.append('../helpers')
+import compile_cache
+import manifest
+import resources
+
+
+def unique_systems(file_name):
+    """Read a systems file and remove any repeated systems (keeping the first ID of each)
+
+    Parameters
+    ----------
+    file_name : `str`
+        File containing list of systems and IDs
+
+    Returns
+    -------
+    systems : `dict`
+        Dictionary mapping system ID to name for each unique system
+    """
+    systems = {}
+    seen = set()
+    for sys_id, sys_name in manifest.read_systems_file(file_name, strip_names=False).items():
+        if sys_name.strip().lower() in seen:
+            continue
+        seen.add(sys_name.strip().lower())
+        systems[sys_id] = sys_name
+    return systems
+
+
+def _run_one(sys_id, sys_name, run_kwargs):
+    """Run a single system in a worker, catching any errors so that the rest of the batch carries on
+
+    Returns
+    -------
+    sys_id : `int`
+        ID of the system
+    error : `str` or `None`
+        Traceback of the error, or None if the system finished
+    runtime : `float`
+        How long the system took in seconds
+    """
+    import optimise_system
+
+    start = time.time()
+    try:
+        optimise_system.run_system(sys_name, system_id=sys_id, **run_kwargs)
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+    return sys_id, error, time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Optimise the parameters of every system in a file in parallel')
+    parser.add_argument('-f', '--file_name', default="systems.txt", type=str,
+                        help='File containing list of systems and IDs')
+    parser.add_argument('-o', '--output_folder', default=".", type=str,
+                        help='Path to folder in which to place output')
+    parser.add_argument('-m', '--mission', default="Kepler", type=str,
+                        help='Which mission to get observations from')
+    parser.add_argument('-e', '--exp_time', default=1800, type=int,
+                        help='Exposure time data to select (0 for every cadence)')
+    parser.add_argument('-j', '--n_workers', default=None, type=int,
+                        help='Number of systems to run at once (default: number of CPUs / threads per worker)')
+    parser.add_argument('-t', '--threads_per_worker', default=1, type=int,
+                        help='Number of threads each system may use')
+    parser.add_argument('-w', '--transit_window', default=None, type=float,
+                        help='Only fit data within this many transit durations of each transit (bin the rest)')
+    parser.add_argument('--manifest', default=None, type=str,
+                        help='Manifest of prefetched parameters to use instead of the Exoplanet Archive')
+    parser.add_argument('--offline', action='store_true',
+                        help='Only use cached Exoplanet Archive responses and the local MAST mirror')
+    parser.add_argument('--warm_start', default=None, type=str,
+                        help='Output folder of previous fits to warm-start from (or reuse if the data are the same)')
+    parser.add_argument('--no_resume', action='store_true',
+                        help='Rerun every stage, even if there is already valid output')
+    parser.add_argument('--prewarm', action='store_true',
+                        help='Compile template models into the node-local Theano cache before starting the systems')
+    args = parser.parse_args()
+
+    # inside a SLURM allocation only use the CPUs that we were given
+    n_cpus = resources.available_cpus()
+    n_workers = args.n_workers if args.n_workers is not None else max(1, n_cpus // args.threads_per_worker)
+
+    systems = unique_systems(args.file_name)
+    print(f"Found {len(systems)} unique systems in {args.file_name}")
+
+    # skip any systems that are already finished (the rest will resume from their last complete stage)
+    if not args.no_resume:
+        # a system only counts as finished if its final pass can actually be loaded (the same check as when a
+        # system resumes), so a stale status file never stops a system from being refit. This doesn't import
+        # the fitting code and the results table is only read once.
+        import optimise_system
+        import results
+
+        loaded_results = results.load_results(args.output_folder)
+        finished = [sys_id for sys_id, sys_name in systems.items()
+                    if optimise_system.system_complete(args.output_folder, sys_name, loaded_results=loaded_results)]
+        systems = {sys_id: sys_name for sys_id, sys_name in systems.items() if sys_id not in finished}
+        print(f"Skipping {len(finished)} systems that are already complete")
+
+    run_kwargs = {"output_folder": args.output_folder, "mission": args.mission,
+                  "exp_time": args.exp_time if args.exp_time > 0 else None, "transit_window": args.transit_window,
+                  "manifest_file": args.manifest, "offline": args.offline or None,
+                  "resume": not args.no_resume, "warm_start": args.warm_start}
+
+    # workers are started fresh (rather than forked) so they pick up these settings before importing numpy
+    resources.set_thread_limits(args.threads_per_worker)
+    os.environ["MPLBACKEND"] = "Agg"
+
+    # every worker shares one compile cache on the node-local disk
+    compile_dir = compile_cache.configure()
+    print(f"Theano compile cache: {compile_dir if compile_dir is not None else 'default'}")
+
+    failed = []
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=get_context("spawn")) as executor:
+        # compile once up front, rather than in every worker at the same time
+        if args.prewarm:
+            start = time.time()
+            executor.submit(compile_cache.prewarm, per_cadence_texp=args.exp_time <= 0).result()
+            print(f"Pre-warmed the compile cache in {time.time() - start:.1f}s")
+
+        futures = [executor.submit(_run_one, sys_id, sys_name, run_kwargs) for sys_id, sys_name in systems.items()]
+        for future in as_completed(futures):
+            sys_id, error, runtime = future.result()
+            if error is None:
+                print(f"Finished system {sys_id} ({systems[sys_id].rstrip()}) in {runtime:.1f}s")
+            else:
+                failed.append(sys_id)
+                print(f"System {sys_id} ({systems[sys_id].rstrip()}) failed after {runtime:.1f}s:")
+                print(error)
+
+    print(f"Batch complete: {len(systems) - len(failed)} succeeded, {len(failed)} failed")
+    if len(failed) > 0:
+        print(f"Failed system IDs: {','.join(str(sys_id) for sys_id in sorted(failed))}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the helpers are imported as top-level modules, as in the slurm scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "helpers"))
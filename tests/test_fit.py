@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+az = pytest.importorskip("arviz")
+pm = pytest.importorskip("pymc3")
+pytest.importorskip("exoplanet")
+
+import fit
+
+
+def test_minimum_ess():
+    """The smallest ESS is found over every element of every variable"""
+    rng = np.random.default_rng(0)
+    trace = az.from_dict(posterior={"a": rng.normal(size=(2, 200)), "b": rng.normal(size=(2, 200, 3))})
+    ess = az.ess(trace)
+
+    min_ess = fit.minimum_ess(trace)
+    assert isinstance(min_ess, float)
+    assert min_ess == pytest.approx(min(float(ess["a"]), float(ess["b"].min())))
+    assert fit.minimum_ess(trace, var_names=["a"]) == pytest.approx(float(ess["a"]))
+
+
+def test_sample_posteriors_tiny_model():
+    """Sampling runs through to the ESS summary (and records it) on a tiny model"""
+    with pm.Model() as model:
+        pm.Normal("x", mu=0.0, sd=1.0, shape=2)
+        pm.Normal("y", mu=0.0, sd=1.0)
+
+    trace = fit.sample_posteriors(model, {"x": np.zeros(2), "y": 0.0}, tune=50, draws=50, chains=2, cores=1)
+    assert trace.posterior["x"].shape == (2, 50, 2)
+    assert trace.sample_stats.attrs["min_ess"] > 0
+    assert trace.sample_stats.attrs["ess_per_second"] > 0
+
+
+@pytest.mark.parametrize("n_planets", [1, 2])
+def test_per_cadence_texp_model(n_planets):
+    """A model with one exposure time per cadence builds, evaluates and matches a model with a single one"""
+    import compile_cache
+
+    scalar = compile_cache.template_model(n_planets=n_planets, per_cadence_texp=False)
+    per_cadence = compile_cache.template_model(n_planets=n_planets, per_cadence_texp=True)
+    assert np.ndim(per_cadence.texp) == 1
+
+    expected = scalar.point_values(scalar.model.test_point)["light_curves"]
+    light_curves = per_cadence.point_values(per_cadence.model.test_point)["light_curves"]
+    assert light_curves.shape == (len(per_cadence.t), n_planets)
+    assert np.all(np.isfinite(light_curves))
+    assert np.any(light_curves < 0)
+    np.testing.assert_allclose(light_curves, expected, rtol=0, atol=1e-9)